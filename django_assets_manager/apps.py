@@ -2,7 +2,8 @@
 from django.apps import AppConfig
 from django.core import checks
 
-from .checks import check_generated
+from .checks import check_generated, check_generated_deploy
+from .scanner import load_registry_on_startup
 
 
 class AssetsManagerConfig(AppConfig):
@@ -11,4 +12,6 @@ class AssetsManagerConfig(AppConfig):
 
 	def ready(self):
 		checks.register()(check_generated)
+		checks.register(deploy=True)(check_generated_deploy)
+		load_registry_on_startup()
 
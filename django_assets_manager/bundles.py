@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from urllib.parse import urljoin
+
+from django.conf import settings as django_settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import settings
+from .utils import AssetNotFoundError, find_file, get_file_hash, get_file_stat, to_localfile, write_if_changed
+
+
+JS_SOURCE_MAP_RE = re.compile(r'^//[#@] sourceMappingURL=(\S+)\s*$', re.MULTILINE)
+CSS_SOURCE_MAP_RE = re.compile(r'/\*[#@] sourceMappingURL=(\S+?)\s*\*/')
+CSS_URL_RE = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+ABSOLUTE_URL_RE = re.compile(r'^(/|#|[a-z][a-z0-9+.-]*:)', re.IGNORECASE)
+
+
+class BundleSource:
+	def __init__(self, url, filename, path=None):
+		self.url = url
+		self.filename = filename
+		# path relative to static roots
+		self.path = path
+		self.content = Path(filename).read_text(encoding='utf-8')
+
+
+def get_bundle_order(asset_list):
+	settings.load_assets()
+	order = []
+	visited = set()
+	for asset in asset_list:
+		settings.get_asset_order(asset, visited, order)
+	return order
+
+
+def get_bundle_sources(order, asset_type):
+	sources = []
+	for asset in order:
+		config = settings.ASSETS_CONFIG[asset]
+		cache_paths = config.get('cache', {}).get('paths', {})
+		paths = config.get(asset_type, [])
+		if isinstance(paths, str):
+			paths = [paths]
+		for path in paths:
+			if path.startswith('static://'):
+				static_path = path[9:]
+				filename = find_file(static_path)
+				url = django_settings.STATIC_URL + static_path
+			elif path in cache_paths:
+				static_path = settings.finder.to_cache_path(asset, cache_paths[path])
+				filename = to_localfile(static_path)
+				if not filename.exists():
+					filename = None
+				# keep protocol relative urls, bundle is served using page protocol
+				url = path
+			else:
+				raise ImproperlyConfigured("File %s of asset %s can't be bundled, it's not local or cached" % (path, asset))
+			if filename is None:
+				raise AssetNotFoundError("File %s not found" % path)
+			sources.append(BundleSource(url, filename, str(static_path)))
+	return sources
+
+
+def identity_source_map(source, lines):
+	return {
+		'version': 3,
+		'sources': [source.url],
+		'names': [],
+		'mappings': ';'.join(['AAAA'] + ['AACA'] * (lines - 1)),
+	}
+
+
+def load_source_map(source, map_url):
+	# only maps of local static files are available
+	if not source.url.startswith(django_settings.STATIC_URL) or ABSOLUTE_URL_RE.match(map_url):
+		return None
+	map_url = urljoin(source.url, map_url)
+	filename = find_file(map_url[len(django_settings.STATIC_URL):])
+	if filename is None:
+		return None
+	try:
+		with open(filename, 'r') as fp:
+			source_map = json.load(fp)
+	except ValueError:
+		return None
+	if 'sections' in source_map or not 'mappings' in source_map:
+		return None
+	root = source_map.pop('sourceRoot', '') or ''
+	if root and not root.endswith('/'):
+		root += '/'
+	source_map['sources'] = [urljoin(map_url, root + src) for src in source_map.get('sources', [])]
+	source_map.pop('file', None)
+	return source_map
+
+
+def rewrite_css_urls(source, content):
+	def replace_url(match):
+		quote, url = match.groups()
+		if ABSOLUTE_URL_RE.match(url):
+			return match.group(0)
+		return 'url(' + quote + urljoin(source.url, url) + quote + ')'
+	return CSS_URL_RE.sub(replace_url, content)
+
+
+def concatenate(sources, asset_type):
+	source_map_re = JS_SOURCE_MAP_RE if asset_type == 'js' else CSS_SOURCE_MAP_RE
+	chunks = []
+	sections = []
+	line = 0
+	for source in sources:
+		content = source.content
+		match = source_map_re.search(content)
+		content = source_map_re.sub('', content).rstrip('\n')
+		if asset_type == 'css':
+			content = rewrite_css_urls(source, content)
+		lines = content.count('\n') + 1
+		source_map = load_source_map(source, match.group(1)) if match else None
+		sections.append({
+			'offset': {'line': line, 'column': 0},
+			'map': source_map or identity_source_map(source, lines),
+		})
+		# separator prevents joining of statements without trailing semicolon
+		chunk = content + ('\n;\n' if asset_type == 'js' else '\n')
+		chunks.append(chunk)
+		line += chunk.count('\n')
+	return ''.join(chunks), sections
+
+
+def build_bundle(name, sources, asset_type):
+	if not sources:
+		return None
+	content, sections = concatenate(sources, asset_type)
+	content_hash = hashlib.md5(content.encode('utf-8')).hexdigest()[:12]
+	filename = '%s.%s.%s' % (name, content_hash, asset_type)
+	path = os.path.join(settings.BUNDLES_DIR, filename)
+
+	if asset_type == 'js':
+		content += '//# sourceMappingURL=' + filename + '.map\n'
+	else:
+		content += '/*# sourceMappingURL=' + filename + '.map */\n'
+	source_map = {'version': 3, 'file': filename, 'sections': sections}
+	write_if_changed(to_localfile(path), content)
+	write_if_changed(to_localfile(path + '.map'), json.dumps(source_map))
+	return path
+
+
+def build_bundles(bundles):
+	manifest = {'bundles': {}}
+	for name, asset_list in bundles.items():
+		if isinstance(asset_list, str):
+			asset_list = [asset_list]
+		order = get_bundle_order(asset_list)
+		bundle = {
+			'assets': order,
+			'config': settings.get_config_hash(order),
+			'sources': {},
+		}
+		for asset_type in ('css', 'js'):
+			sources = get_bundle_sources(order, asset_type)
+			# changed content of source invalidates bundle, content is hashed only when stats differ
+			bundle['sources'].update((source.path, [get_file_hash(source.filename)] + get_file_stat(source.filename)) for source in sources)
+			path = build_bundle(name, sources, asset_type)
+			if path is not None:
+				bundle[asset_type] = path
+		manifest['bundles'][name] = bundle
+	write_if_changed(settings.get_bundles_manifest_path(), json.dumps(manifest, indent=1, sort_keys=True))
+	settings.reload_assets()
+	return manifest
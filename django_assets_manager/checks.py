@@ -1,18 +1,31 @@
 # -*- coding: utf-8 -*-
+from django.conf import settings
 from django.core.checks import Error
 
 from .settings import SPRITES
 from .utils import SpriteCompiler
 
 
+def sprites_error():
+	return Error(
+		'Sprites not generated',
+		hint='Run manage.py compilesprites',
+		id='django_assets_manager.E001'
+	)
+
+
 def check_generated(**kwargs):
-	errors = []
+	if getattr(settings, 'ASSETS_MANAGER_SPRITES_CHECK', 'always') == 'deploy':
+		return []
 
 	compiler = SpriteCompiler()
 	if compiler.recompilation_needed(SPRITES):
-		errors.append(Error(
-			'Sprites not generated',
-			hint='Run manage.py compilesprites',
-			id='django_assets_manager.E001'
-		))
-	return errors
+		return [sprites_error()]
+	return []
+
+
+def check_generated_deploy(**kwargs):
+	compiler = SpriteCompiler()
+	if compiler.recompilation_needed(SPRITES, full=True):
+		return [sprites_error()]
+	return []
@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.error import HTTPError, URLError
 
 from django.conf import settings as django_settings
 from django.contrib.staticfiles.finders import BaseFinder
@@ -9,6 +14,8 @@ from django.core.files.storage import FileSystemStorage
 from urllib.request import urlopen
 
 from . import settings
+from .signals import measure
+from .utils import set_default_mode
 
 
 class CdnFinder(BaseFinder):
@@ -20,35 +27,74 @@ class CdnFinder(BaseFinder):
 		return [] # pragma: no cover
 
 	def list(self, ignore_patterns):
-		for package, data in settings.ASSETS.items():
+		paths = []
+		for package, data in settings.load_assets().items():
 			if "cache" in data:
 				for src, dest in data["cache"]["paths"].items():
-					dest_path = Path(self.storage.path(self.to_cache_path(package, dest)))
 					if matches_patterns(dest, ignore_patterns): # pragma: no cover
 						continue
-					if not dest_path.exists():
-						dest_path.parent.mkdir(parents=True, exist_ok=True)
-						content = urlopen(self.to_url(src)).read()
-						with dest_path.open('wb') as fp:
-							fp.write(content)
-					yield dest, self.storage
+					paths.append((src, dest, Path(self.storage.path(self.to_cache_path(package, dest)))))
+
+		missing = [(src, dest_path) for src, __, dest_path in paths if not dest_path.exists()]
+		if missing:
+			with ThreadPoolExecutor(max_workers=min(settings.CDN_WORKERS, len(missing))) as executor:
+				for future in [executor.submit(self.download, src, dest_path) for src, dest_path in missing]:
+					future.result()
+
+		for __, dest, __ in paths:
+			yield dest, self.storage
+
+	def download(self, url, dest_path):
+		dest_path.parent.mkdir(parents=True, exist_ok=True)
+		with measure('download', url=url) as info:
+			info['attempts'] = 1
+			while True:
+				try:
+					self.download_file(url, dest_path)
+					return
+				except (URLError, OSError) as e:
+					# client errors are not retried
+					if info['attempts'] > settings.CDN_RETRIES or (isinstance(e, HTTPError) and e.code < 500):
+						raise
+				time.sleep(settings.CDN_RETRY_DELAY * 2 ** (info['attempts'] - 1))
+				info['attempts'] += 1
+
+	def download_file(self, url, dest_path):
+		fd, tmp_path = tempfile.mkstemp(dir=dest_path.parent, prefix='.' + dest_path.name, suffix='.tmp')
+		try:
+			with os.fdopen(fd, 'wb') as fp, urlopen(self.to_url(url), timeout=settings.CDN_TIMEOUT) as response:
+				shutil.copyfileobj(response, fp, 65536)
+				length = response.headers.get('Content-Length')
+				if length is not None and fp.tell() != int(length):
+					raise URLError("Incomplete download of %s" % url)
+			set_default_mode(tmp_path)
+			os.replace(tmp_path, dest_path)
+		except BaseException:
+			os.unlink(tmp_path)
+			raise
 
 	def to_cache_path(self, package, dest):
 		return os.path.join('CACHE', package, dest)
 
-	def transform_and_check_path(self, package, path):
-		dest_cache = settings.ASSETS.get(package, {}).get('cache', {}).get('paths', {})
-		if not path in dest_cache:
+	def get_cached_files(self):
+		cached_files = set()
+		cache_dir = self.storage.path('CACHE')
+		for root, __, files in os.walk(cache_dir):
+			relative_root = os.path.join('CACHE', os.path.relpath(root, cache_dir))
+			cached_files.update(os.path.normpath(os.path.join(relative_root, filename)) for filename in files)
+		return cached_files
+
+	def transform_and_check_path(self, package, path, cache_paths, cached_files):
+		if not path in cache_paths:
 			return path
-		dest = self.to_cache_path(package, dest_cache[path])
-		cache_path = Path(self.storage.path(dest))
-		if cache_path.exists():
-			return django_settings.STATIC_URL + dest
+		dest = self.to_cache_path(package, cache_paths[path])
+		if os.path.normpath(dest) in cached_files:
+			return settings.get_static_url(dest)
 		else:
 			return path
 
-	def transform_to_cache(self, package, paths):
-		return [self.transform_and_check_path(package, path) for path in paths]
+	def transform_to_cache(self, package, paths, cache_paths, cached_files):
+		return [self.transform_and_check_path(package, path, cache_paths, cached_files) for path in paths]
 
 	def to_url(self, url):
 		if url[:2] == '//':
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+
+from django.core.exceptions import ImproperlyConfigured
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from .settings import registry_state
+from .signals import stage_finished
+from .templatetags.assets_manager import emit_assets, emit_measured_assets, get_asset_sources, get_render_request
+
+
+TAG_TYPES = {
+	'assets': ('css', 'js'),
+	'assets_css': ('css',),
+	'assets_js': ('js',),
+}
+CompiledAssets = namedtuple('CompiledAssets', ['generation', 'resolved'])
+
+
+class AssetsExtension(Extension):
+	tags = set(TAG_TYPES)
+
+	def __init__(self, environment):
+		super().__init__(environment)
+		# (asset_types, asset_list) -> assets resolved for registry generation
+		self.compiled = {}
+
+	def parse(self, parser):
+		token = next(parser.stream)
+		asset_types = TAG_TYPES[token.value]
+		args = []
+		while parser.stream.current.type != 'block_end':
+			if args:
+				parser.stream.expect('comma')
+			args.append(parser.parse_expression())
+
+		if all(isinstance(arg, nodes.Const) and isinstance(arg.value, str) for arg in args):
+			asset_list = tuple(arg.value for arg in args)
+			try:
+				self.resolve(asset_types, asset_list)
+			except ImproperlyConfigured:
+				# raised when template is rendered
+				pass
+			call = self.call_method('render_compiled', [nodes.ContextReference(), nodes.Const(asset_types), nodes.Const(asset_list)])
+		else:
+			call = self.call_method('render_dynamic', [nodes.ContextReference(), nodes.Const(asset_types), nodes.Tuple(args, 'load')])
+		return nodes.Output([call], lineno=token.lineno)
+
+	def resolve(self, asset_types, asset_list):
+		generation = registry_state['generation']
+		compiled = CompiledAssets(generation, tuple((asset_type, get_asset_sources(asset_type, asset_list)) for asset_type in asset_types))
+		self.compiled[(asset_types, asset_list)] = compiled
+		return compiled
+
+	def render_compiled(self, context, asset_types, asset_list):
+		if stage_finished.receivers:
+			return self.render_dynamic(context, asset_types, asset_list)
+		compiled = self.compiled.get((asset_types, asset_list))
+		if compiled is None or compiled.generation != registry_state['generation']:
+			compiled = self.resolve(asset_types, asset_list)
+		request = get_render_request(context)
+		return Markup(''.join(emit_assets(request, asset_type, resolved) for asset_type, resolved in compiled.resolved))
+
+	def render_dynamic(self, context, asset_types, asset_list):
+		request = get_render_request(context)
+		if stage_finished.receivers:
+			return Markup(''.join(emit_measured_assets(request, asset_type, asset_list) for asset_type in asset_types))
+		return Markup(''.join(emit_assets(request, asset_type, get_asset_sources(asset_type, asset_list)) for asset_type in asset_types))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...bundles import build_bundles
+from ...scanner import plan_bundles
+
+
+class Command(BaseCommand):
+	help = "Concatenate assets declared in ASSETS_MANAGER_BUNDLES to content hashed files"
+	requires_system_checks = []
+
+	def add_arguments(self, parser):
+		parser.add_argument('--templates', action='store_true', help="Add bundle for assets of every template found by scanassets")
+
+	def handle(self, *args, **options): #pylint: disable=unused-argument
+		bundles = {}
+		if options['templates']:
+			bundles.update(plan_bundles())
+		bundles.update(getattr(settings, 'ASSETS_MANAGER_BUNDLES', {}))
+		if not bundles:
+			raise CommandError("ASSETS_MANAGER_BUNDLES is not defined")
+		manifest = build_bundles(bundles)
+		if options['verbosity'] > 0:
+			for name, bundle in manifest['bundles'].items():
+				self.stdout.write("%s: %s" % (name, ', '.join(bundle.get(asset_type, '-') for asset_type in ('css', 'js'))))
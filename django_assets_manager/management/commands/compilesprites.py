@@ -8,6 +8,10 @@ from ...settings import SPRITES
 class Command(BaseCommand):
 	requires_system_checks = []
 
-	def handle(self, *args, **opions): #pylint: disable=unused-argument
-		compiler = utils.SpriteCompiler()
+	def add_arguments(self, parser):
+		parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of sprite sheets / pixel ratios compiled in parallel")
+		parser.add_argument('--force', action='store_true', help="Rebuild sprite sheets even if sources are not changed")
+
+	def handle(self, *args, **options): #pylint: disable=unused-argument
+		compiler = utils.SpriteCompiler(jobs=options['jobs'], force=options['force'])
 		compiler.compile(SPRITES)
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from ... import settings
+
+
+class Command(BaseCommand):
+	help = "Download files cached from CDN"
+	requires_system_checks = []
+
+	def handle(self, *args, **options): #pylint: disable=unused-argument
+		settings.reload_assets()
+		count = len(list(settings.finder.list(ignore_patterns=[])))
+		settings.reload_assets(full=True)
+		if options['verbosity'] > 0:
+			self.stdout.write("%d cached files available" % count)
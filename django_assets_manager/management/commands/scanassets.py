@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from ...scanner import build_index
+
+
+class Command(BaseCommand):
+	help = "Find assets used in templates and write index used to warm up caches"
+	requires_system_checks = []
+
+	def handle(self, *args, **options): #pylint: disable=unused-argument
+		index = build_index()
+		if options['verbosity'] > 0:
+			templates = [template for template in index['templates'].values() if template['assets']]
+			self.stdout.write("%d templates using assets" % len(templates))
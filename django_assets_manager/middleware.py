@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from functools import wraps
+from html import unescape
+
+from django.conf import settings as django_settings
+from django.utils.encoding import iri_to_uri
+
+from .settings import ASSET_IDS, ASSETS, BUNDLES, RESOLUTION_CACHE, TEMPLATE_ASSETS, get_asset_order, load_assets
+
+
+PRELOAD_DESTINATIONS = (('css', 'style'), ('js', 'script'))
+
+
+def preload_assets(*asset_list):
+	def decorator(view_func):
+		@wraps(view_func)
+		def wrapped_view(*args, **kwargs):
+			return view_func(*args, **kwargs)
+		wrapped_view.assets_preload = asset_list
+		return wrapped_view
+	return decorator
+
+
+def get_preload_urls(asset_type, order):
+	mask = 0
+	for asset in order:
+		mask |= 1 << ASSET_IDS[asset]
+	# same bundle which is emitted by template tag rendering all assets at once
+	for bundle in BUNDLES:
+		bundle_mask = 0
+		for asset in bundle['assets']:
+			bundle_mask |= 1 << ASSET_IDS[asset]
+		if bundle.get(asset_type) and bundle_mask == mask:
+			return [django_settings.STATIC_URL + bundle[asset_type]]
+	return [unescape(url) for asset in order for url, __ in ASSETS[asset].get(asset_type, [])]
+
+
+def get_preload_links(asset_list):
+	# cached together with resolved template tags, key can't collide with asset type
+	key = (None, asset_list)
+	links = RESOLUTION_CACHE.get(key)
+	if links is None:
+		load_assets()
+		order = []
+		visited = set()
+		for asset in asset_list:
+			get_asset_order(asset, visited, order)
+		links = []
+		for asset_type, destination in PRELOAD_DESTINATIONS:
+			for url in get_preload_urls(asset_type, order):
+				links.append(f'<{iri_to_uri(url)}>; rel=preload; as={destination}')
+		links = ', '.join(links)
+		RESOLUTION_CACHE[key] = links
+	return links
+
+
+class PreloadMiddleware(object):
+	def __init__(self, get_response):
+		self.get_response = get_response
+
+	def __call__(self, request):
+		response = self.get_response(request)
+		links = getattr(request, 'assets_preload_links', '')
+		if links:
+			if 'Link' in response:
+				links = response['Link'] + ', ' + links
+			response['Link'] = links
+		return response
+
+	def process_view(self, request, view_func, *__):
+		asset_list = getattr(view_func, 'assets_preload', None)
+		template_name = getattr(getattr(view_func, 'view_class', None), 'template_name', None)
+		if asset_list is None and template_name:
+			# assets of class based views found by scanassets
+			load_assets()
+			asset_list = TEMPLATE_ASSETS.get(template_name)
+		if asset_list:
+			# computed before view is executed, errors in configuration are raised early
+			request.assets_preload_links = get_preload_links(asset_list)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from debug_toolbar.panels import Panel
+
+from .signals import stage_finished
+
+
+class AssetsPanel(Panel):
+	title = "Assets"
+	template = 'assets_manager/debug_toolbar_panel.html'
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.thread = None
+		self.calls = []
+		self.stages = {}
+
+	@property
+	def nav_subtitle(self):
+		stats = self.get_stats()
+		if not stats:
+			return ''
+		return "%d calls in %.2f ms" % (len(stats['calls']), stats['total_time'])
+
+	def record(self, stage, duration, info, **kwargs): #pylint: disable=unused-argument
+		# signals of other threads don't belong to this request
+		if threading.get_ident() != self.thread:
+			return
+		duration *= 1000
+		if stage == 'assets':
+			self.calls.append({
+				'asset_type': info['asset_type'],
+				'asset_list': ', '.join(info['asset_list']),
+				'emitted': ', '.join(info.get('emitted', [])),
+				'cache_hit': info['cache_hit'],
+				'time': duration,
+			})
+		else:
+			count, total = self.stages.get(stage, (0, 0))
+			self.stages[stage] = (count + 1, total + duration)
+
+	def enable_instrumentation(self):
+		self.thread = threading.get_ident()
+		stage_finished.connect(self.record)
+
+	def disable_instrumentation(self):
+		stage_finished.disconnect(self.record)
+
+	def generate_stats(self, request, response):
+		self.record_stats({
+			'calls': self.calls,
+			'cache_hits': sum(1 for call in self.calls if call['cache_hit']),
+			'total_time': sum(call['time'] for call in self.calls),
+			'stages': [{'stage': stage, 'count': count, 'time': total} for stage, (count, total) in sorted(self.stages.items())],
+		})
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import re
+
+from django.conf import settings as django_settings
+from django.core.exceptions import ImproperlyConfigured
+from django.template import engines
+from django.template.backends.django import DjangoTemplates
+from django.template.base import Lexer, TokenType
+from django.template.utils import get_app_template_dirs
+
+from . import settings
+from .utils import to_localfile, write_if_changed
+
+try:
+	from jinja2 import TemplateSyntaxError, nodes
+except ImportError: # pragma: no cover
+	pass
+
+
+TAG_TYPES = {
+	'assets': ['css', 'js'],
+	'assets_css': ['css'],
+	'assets_js': ['js'],
+}
+INDEX_VERSION = 1
+
+
+def get_templates_index_path():
+	path = getattr(django_settings, 'ASSETS_MANAGER_TEMPLATES_INDEX', None)
+	if path is None:
+		return to_localfile('.assets_manager_templates.json')
+	return path or None
+
+
+def get_literal(bit):
+	if len(bit) >= 2 and bit[0] == bit[-1] and bit[0] in '"\'':
+		return bit[1:-1]
+	return None
+
+
+def scan_django_template(source):
+	calls = []
+	depends = []
+	for token in Lexer(source).tokenize():
+		if token.token_type != TokenType.BLOCK:
+			continue
+		bits = token.split_contents()
+		if not bits:
+			continue
+		if bits[0] in TAG_TYPES:
+			args = [get_literal(bit) for bit in bits[1:]]
+			if args and None not in args:
+				calls.append([TAG_TYPES[bits[0]], args])
+		elif bits[0] in ('extends', 'include') and len(bits) > 1:
+			name = get_literal(bits[1])
+			if name is not None:
+				depends.append(name)
+	return calls, depends
+
+
+def scan_jinja_template(environment, source):
+	calls = []
+	depends = []
+	try:
+		ast = environment.parse(source)
+	except TemplateSyntaxError:
+		return calls, depends
+	for node in ast.find_all((nodes.Call, nodes.Extends, nodes.Include)):
+		if isinstance(node, nodes.Call):
+			args = [arg.value if isinstance(arg, nodes.Const) and isinstance(arg.value, str) else None for arg in node.args]
+			if isinstance(node.node, nodes.Name) and node.node.name in TAG_TYPES and args and None not in args:
+				calls.append([TAG_TYPES[node.node.name], args])
+			# tags of AssetsExtension with literal arguments
+			elif isinstance(node.node, nodes.ExtensionAttribute) and node.node.name == 'render_compiled':
+				calls.append([list(node.args[1].value), list(node.args[2].value)])
+		elif isinstance(node.template, nodes.Const) and isinstance(node.template.value, str):
+			depends.append(node.template.value)
+	return calls, depends
+
+
+def iter_django_templates(backend):
+	dirs = list(backend.engine.dirs)
+	if backend.engine.app_dirs:
+		dirs += list(get_app_template_dirs('templates'))
+	for template_dir in dirs:
+		for root, __, files in os.walk(template_dir):
+			for filename in sorted(files):
+				path = os.path.join(root, filename)
+				try:
+					with open(path, 'r', encoding='utf-8') as fp:
+						source = fp.read()
+				except (OSError, UnicodeDecodeError):
+					continue
+				yield os.path.relpath(path, template_dir).replace(os.sep, '/'), scan_django_template(source)
+
+
+def iter_jinja_templates(backend):
+	environment = backend.env
+	for name in environment.list_templates():
+		try:
+			source = environment.loader.get_source(environment, name)[0]
+		except UnicodeDecodeError:
+			continue
+		yield name, scan_jinja_template(environment, source)
+
+
+def scan_templates():
+	templates = {}
+	for backend in engines.all():
+		if isinstance(backend, DjangoTemplates):
+			found = iter_django_templates(backend)
+		elif hasattr(backend, 'env'):
+			found = iter_jinja_templates(backend)
+		else:
+			continue
+		for name, (calls, depends) in found:
+			template = templates.setdefault(name, {'calls': [], 'depends': []})
+			template['calls'].extend(calls)
+			template['depends'].extend(depend for depend in depends if depend not in template['depends'])
+	return templates
+
+
+def get_template_assets(templates, name, visited, asset_list):
+	if name in visited or name not in templates:
+		return
+	visited.add(name)
+	for __, assets in templates[name]['calls']:
+		asset_list.extend(asset for asset in assets if asset not in asset_list)
+	for depend in templates[name]['depends']:
+		get_template_assets(templates, depend, visited, asset_list)
+
+
+def build_index():
+	settings.load_assets()
+	templates = scan_templates()
+	for name, template in templates.items():
+		asset_list = []
+		get_template_assets(templates, name, set(), asset_list)
+		order = []
+		visited = set()
+		for asset in asset_list:
+			settings.get_asset_order(asset, visited, order)
+		template['assets'] = order
+	index = {'version': INDEX_VERSION, 'templates': templates}
+	path = get_templates_index_path()
+	if path is not None:
+		write_if_changed(path, json.dumps(index, indent=1, sort_keys=True))
+	settings.reload_assets()
+	return index
+
+
+def load_index():
+	path = get_templates_index_path()
+	if path is None:
+		return {}
+	try:
+		with open(path, 'r') as fp:
+			index = json.load(fp)
+	except (OSError, ValueError):
+		return {}
+	if index.get('version') != INDEX_VERSION:
+		return {}
+	return index
+
+
+def warm_resolution_cache():
+	# template tags module imports registry
+	from .templatetags.assets_manager import get_asset_sources
+
+	settings.TEMPLATE_ASSETS.clear()
+	for name, template in load_index().get('templates', {}).items():
+		if all(asset in settings.ASSETS for asset in template['assets']):
+			settings.TEMPLATE_ASSETS[name] = tuple(template['assets'])
+		for asset_types, asset_list in template['calls']:
+			for asset_type in asset_types:
+				try:
+					get_asset_sources(asset_type, tuple(asset_list))
+				except ImproperlyConfigured:
+					pass
+
+
+def load_registry_on_startup():
+	if load_index():
+		settings.load_assets()
+
+
+def plan_bundles():
+	bundles = {}
+	planned = set()
+	for name, template in sorted(load_index().get('templates', {}).items()):
+		asset_list = tuple(template['assets'])
+		if len(asset_list) > 1 and asset_list not in planned:
+			planned.add(asset_list)
+			bundles[re.sub(r'[^\w-]+', '-', name)] = list(asset_list)
+	return bundles
@@ -1,44 +1,90 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import threading
 from copy import deepcopy
 from itertools import zip_longest
 
 from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestFilesMixin, staticfiles_storage
+from django.core.exceptions import ImproperlyConfigured
 from django.dispatch import receiver
 from django.test.signals import setting_changed
 from django.utils.html import escape
 
 from .finders import CdnFinder
+from .scanner import warm_resolution_cache
+from .utils import find_file, get_file_hash, get_file_stat
 
 
-ASSETS = deepcopy(getattr(settings, 'ASSETS_MANAGER_FILES', {}))
+# converted assets, built lazily using load_assets()
+ASSETS = {}
+# configuration of converted assets, used to detect changed entries
+ASSETS_CONFIG = {}
 SPRITES = deepcopy(list(getattr(settings, 'ASSETS_MANAGER_SPRITES', [])))
 USE_TEMPLATES = getattr(settings, 'ASSETS_MANAGER_USE_TEMPLATES', False)
+DETECT_RENDER_NODELIST = getattr(settings, 'ASSETS_MANAGER_DETECT_RENDER_NODELIST', False)
+CDN_WORKERS = getattr(settings, 'ASSETS_MANAGER_CDN_WORKERS', 8)
+CDN_TIMEOUT = getattr(settings, 'ASSETS_MANAGER_CDN_TIMEOUT', 30)
+CDN_RETRIES = getattr(settings, 'ASSETS_MANAGER_CDN_RETRIES', 2)
+CDN_RETRY_DELAY = getattr(settings, 'ASSETS_MANAGER_CDN_RETRY_DELAY', 1)
+BUNDLES_DIR = getattr(settings, 'ASSETS_MANAGER_BUNDLES_DIR', 'CACHE/bundles')
+# bundles created by bundleassets command, which are valid for current configuration
+BUNDLES = []
+# asset name -> bit index used in emitted asset masks
+ASSET_IDS = {}
+# (asset_type, asset_list) -> resolved mask and rendered fragments in dependency order
+RESOLUTION_CACHE = {}
+# template name -> assets used by template and templates it extends or includes (from scanassets index)
+TEMPLATE_ASSETS = {}
 
 
 finder = CdnFinder()
+registry_lock = threading.Lock()
+# generation is changed on every reload, used to detect outdated resolved assets
+registry_state = {'loaded': False, 'generation': 0}
+# settings which change URL of every registered file
+URL_SETTINGS = {'ASSETS_MANAGER_VERSIONED_URLS', 'STATIC_URL', 'STATICFILES_STORAGE', 'STORAGES'}
+
+
+def get_static_url(path):
+	if not getattr(settings, 'ASSETS_MANAGER_VERSIONED_URLS', False):
+		return settings.STATIC_URL + path
+	# names hashed by collectstatic
+	if isinstance(staticfiles_storage, ManifestFilesMixin) and not settings.DEBUG:
+		try:
+			return staticfiles_storage.url(path)
+		except ValueError:
+			pass
+	filename = find_file(path)
+	if filename is None:
+		return settings.STATIC_URL + path
+	return settings.STATIC_URL + path + '?v=' + get_file_hash(filename)[:12]
 
 
 def transform_static(path):
 	if path.find("static://") != 0:
 		return path
-	return settings.STATIC_URL + path[9:]
+	return get_static_url(path[9:])
 
 
-def convert_asset_data(name, asset):
+def convert_asset_data(name, asset, cached_files):
 	asset.setdefault("depends", [])
+	cache_paths = asset.get('cache', {}).get('paths', {})
 
 	asset.setdefault("css", [])
 	if isinstance(asset["css"], str):
 		asset["css"] = [asset["css"]]
 	asset['css'] = [transform_static(path) for path in asset['css']]
-	asset['css'] = finder.transform_to_cache(name, asset['css'])
+	asset['css'] = finder.transform_to_cache(name, asset['css'], cache_paths, cached_files)
 	asset['css'] = [escape(item) for item in asset['css']]
 
 	asset.setdefault("js", [])
 	if isinstance(asset["js"], str):
 		asset["js"] = [asset["js"]]
 	asset['js'] = [transform_static(path) for path in asset['js']]
-	asset['js'] = finder.transform_to_cache(name, asset['js'])
+	asset['js'] = finder.transform_to_cache(name, asset['js'], cache_paths, cached_files)
 	asset['js'] = [escape(item) for item in asset['js']]
 
 	asset["css"] = list(zip_longest(asset['css'], {}, fillvalue=''))
@@ -46,24 +92,103 @@ def convert_asset_data(name, asset):
 	return asset
 
 
+def get_asset_order(asset, visited, order):
+	if asset in visited:
+		return
+	if not asset in ASSETS:
+		raise ImproperlyConfigured("Asset %s not registered" % asset)
+
+	visited.add(asset)
+	for depend in ASSETS[asset]["depends"]:
+		get_asset_order(depend, visited, order)
+	order.append(asset)
+
+
+def get_config_hash(names):
+	config = [[name, ASSETS_CONFIG[name]] for name in names]
+	return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_bundles_manifest_path():
+	return os.path.join(settings.STATICFILES_DIRS[0], BUNDLES_DIR, '.manifest.json')
+
+
+def load_bundles():
+	try:
+		with open(get_bundles_manifest_path(), 'r') as fp:
+			manifest = json.load(fp)
+	except (OSError, ValueError):
+		return []
+	bundles = []
+	for bundle in manifest.get('bundles', {}).values():
+		# bundle is outdated if configuration of assets or content of sources was changed
+		if all(name in ASSETS_CONFIG for name in bundle['assets']) and get_config_hash(bundle['assets']) == bundle['config'] and bundle_sources_valid(bundle):
+			bundles.append(bundle)
+	return bundles
+
+
+def bundle_sources_valid(bundle):
+	if 'sources' not in bundle:
+		return False
+	for path, (content_hash, *stat) in bundle['sources'].items():
+		filename = find_file(path)
+		if filename is None:
+			return False
+		if get_file_stat(filename) != stat and get_file_hash(filename) != content_hash:
+			return False
+	return True
+
+
+def build_assets():
+	config = getattr(settings, 'ASSETS_MANAGER_FILES', {})
+	changed = [name for name, value in config.items() if name not in ASSETS or ASSETS_CONFIG.get(name) != value]
+	cached_files = finder.get_cached_files() if any('cache' in config[name] for name in changed) else set()
+
+	assets = {name: ASSETS[name] for name in config if name in ASSETS}
+	for name in changed:
+		ASSETS_CONFIG[name] = deepcopy(config[name])
+		assets[name] = convert_asset_data(name, dict(ASSETS_CONFIG[name]), cached_files)
+	for name in set(ASSETS_CONFIG) - set(config):
+		del ASSETS_CONFIG[name]
+
+	ASSETS.clear()
+	ASSETS.update((name, assets[name]) for name in config)
+	ASSET_IDS.clear()
+	ASSET_IDS.update({n: i for i, n in enumerate(ASSETS)})
+	BUNDLES[:] = load_bundles()
+	RESOLUTION_CACHE.clear()
+
+
+def load_assets():
+	if not registry_state['loaded']:
+		with registry_lock:
+			if not registry_state['loaded']: # pragma: no branch
+				build_assets()
+				registry_state['loaded'] = True
+				# tag resolution needs loaded registry
+				warm_resolution_cache()
+	return ASSETS
+
+
+def reload_assets(full=False):
+	with registry_lock:
+		registry_state['loaded'] = False
+		registry_state['generation'] += 1
+		RESOLUTION_CACHE.clear()
+		if full:
+			ASSETS.clear()
+			ASSETS_CONFIG.clear()
+
+
 @receiver(setting_changed)
 def update_settings(**kwargs):
 	setting = kwargs.get('setting')
+	if setting in URL_SETTINGS:
+		reload_assets(full=True)
+		return
 	if setting is not None and setting not in {'ASSETS_MANAGER_FILES', 'ASSETS_MANAGER_SPRITES'}:
 		return
 	sprites = deepcopy(list(getattr(settings, 'ASSETS_MANAGER_SPRITES', [])))
 	SPRITES.clear()
 	SPRITES.extend(sprites)
-
-	assets = deepcopy(getattr(settings, 'ASSETS_MANAGER_FILES', {}))
-	ASSETS.clear()
-	ASSETS.update({n: v for n, v in assets.items()}) # cache is used in convert_asset_data
-	ASSETS.update({n: convert_asset_data(n, v) for n, v in assets.items()})
-	# download assets
-	list(finder.list(ignore_patterns=[]))
-	assets = deepcopy(getattr(settings, 'ASSETS_MANAGER_FILES', {}))
-	ASSETS.update({n: v for n, v in assets.items()})
-	ASSETS.update({n: convert_asset_data(n, v) for n, v in assets.items()})
-
-
-update_settings()
+	reload_assets()
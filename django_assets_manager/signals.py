@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+import time
+from contextlib import contextmanager
+
+from django.dispatch import Signal
+
+
+# sent after measured stage with arguments stage, duration (seconds) and info (dict)
+stage_finished = Signal()
+
+
+@contextmanager
+def measure(stage, **info):
+	# nothing is measured without receivers
+	if not stage_finished.receivers:
+		yield info
+		return
+	start = time.perf_counter()
+	try:
+		yield info
+	finally:
+		stage_finished.send(sender=None, stage=stage, duration=time.perf_counter() - start, info=info)
@@ -1,16 +1,50 @@
 # -*- coding: utf-8 -*-
-import traceback
-from itertools import chain
+import sys
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
 
 from django import template
-from django.core.exceptions import ImproperlyConfigured
+from django.conf import settings as django_settings
 from django.template.loader import render_to_string
+from django.utils.html import escape
 from django.utils.safestring import mark_safe
 
-from ..settings import ASSETS, USE_TEMPLATES
+from ..settings import ASSET_IDS, ASSETS, BUNDLES, DETECT_RENDER_NODELIST, RESOLUTION_CACHE, USE_TEMPLATES, get_asset_order, load_assets
+from ..signals import measure, stage_finished
 
 
 register = template.Library()
+nested_render_state = ContextVar('assets_manager_nested_render', default=False)
+ResolvedAssets = namedtuple('ResolvedAssets', ['mask', 'sources', 'output', 'bundles'])
+
+
+@contextmanager
+def nested_render():
+	token = nested_render_state.set(True)
+	try:
+		yield
+	finally:
+		nested_render_state.reset(token)
+
+
+def render_nodelist(nodelist, context):
+	with nested_render():
+		return nodelist.render(context)
+
+
+def is_nested_render():
+	if nested_render_state.get():
+		return True
+	if not DETECT_RENDER_NODELIST:
+		return False
+	# compatibility with render_nodelist functions of projects, only names of code objects are compared
+	frame = sys._getframe(2) #pylint: disable=protected-access
+	while frame is not None:
+		if frame.f_code.co_name == 'render_nodelist':
+			return True
+		frame = frame.f_back
+	return False
 
 
 class ShadowRequest(object):
@@ -23,12 +57,10 @@ class FakeRequest(object):
 		self.__dict__['requests'] = [ShadowRequest(), ShadowRequest()]
 
 	def __getattr__(self, item):
-		fake = any(f[2] == 'render_nodelist' for f in traceback.extract_stack())
-		return getattr(self.__dict__['requests'][0 if fake else 1], item)
+		return getattr(self.__dict__['requests'][0 if is_nested_render() else 1], item)
 
 	def __setattr__(self, item, value):
-		fake = any(f[2] == 'render_nodelist' for f in traceback.extract_stack())
-		return setattr(self.__dict__['requests'][0 if fake else 1], item, value)
+		return setattr(self.__dict__['requests'][0 if is_nested_render() else 1], item, value)
 
 
 def render_css(context):
@@ -39,47 +71,91 @@ def render_js(context):
 	return ''.join(f'<script src="{src}"{attributes}></script>' for src, attributes in context['data'])
 
 
-def get_asset_sources(asset, unused, asset_type, render):
-	if not asset in unused:
-		if not asset in ASSETS:
-			raise ImproperlyConfigured("Asset %s not registered" % asset)
-		return ()
-
-	asset_data = ASSETS[asset]
-	unused.remove(asset)
-
-	sources = []
-	for depend in asset_data["depends"]:
-		sources += get_asset_sources(depend, unused, asset_type, render)
-
-	if asset_data[asset_type]:
-		sources.append(render({'data': asset_data[asset_type]}))
-	return sources
-
-
-def get_or_create_unused_assets(context, asset_type):
+def get_renderer(asset_type):
+	if USE_TEMPLATES or asset_type not in ('css', 'js'):
+		return lambda context: render_to_string("assets_manager/" + asset_type + ".html", context)
+	else:
+		return render_css if asset_type == 'css' else render_js
+
+
+def get_asset_sources(asset_type, asset_list):
+	key = (asset_type, asset_list)
+	resolved = RESOLUTION_CACHE.get(key)
+	if resolved is None:
+		load_assets()
+		with measure('resolve', asset_list=asset_list):
+			order = []
+			visited = set()
+			for asset in asset_list:
+				get_asset_order(asset, visited, order)
+
+		render = get_renderer(asset_type)
+		with measure('render', asset_type=asset_type, asset_list=asset_list):
+			mask = 0
+			sources = []
+			for asset in order:
+				bit = 1 << ASSET_IDS[asset]
+				mask |= bit
+				data = ASSETS[asset].get(asset_type)
+				if data:
+					sources.append((bit, render({'data': data})))
+			bundles = []
+			for bundle in BUNDLES:
+				bundle_mask = 0
+				for asset in bundle['assets']:
+					bundle_mask |= 1 << ASSET_IDS[asset]
+				# bundle can replace only requested assets
+				if bundle.get(asset_type) and not bundle_mask & ~mask:
+					url = escape(django_settings.STATIC_URL + bundle[asset_type])
+					bundles.append((bundle_mask, render({'data': [(url, '')]})))
+		resolved = ResolvedAssets(mask, tuple(sources), ''.join(source for __, source in sources), tuple(bundles))
+		RESOLUTION_CACHE[key] = resolved
+	return resolved
+
+
+def get_render_request(context):
 	if not "request" in context:
 		extra = {'request': FakeRequest()}
 		if hasattr(context, 'update'):
 			context.update(extra)
 		else:
 			context.vars.update(extra)
-	if hasattr(context["request"], "unused_" + asset_type):
-		return getattr(context["request"], "unused_" + asset_type)
-	else:
-		unused_assets = set(ASSETS.keys())
-		setattr(context["request"], "unused_" + asset_type, unused_assets)
-		return unused_assets
+	return context["request"]
+
+
+def emit_assets(request, asset_type, resolved):
+	attribute = 'assets_emitted_' + asset_type
+	emitted = getattr(request, attribute, 0)
+	missing = resolved.mask & ~emitted
+	if not missing:
+		return ''
+	for bundle_mask, source in resolved.bundles:
+		# bundle must contain exactly the missing assets, other code is never executed
+		if bundle_mask == missing:
+			setattr(request, attribute, emitted | bundle_mask)
+			return source
+	setattr(request, attribute, emitted | resolved.mask)
+	if missing == resolved.mask:
+		return resolved.output
+	return ''.join(source for bit, source in resolved.sources if bit & missing)
+
+
+def emit_measured_assets(request, asset_type, asset_list):
+	with measure('assets', asset_type=asset_type, asset_list=asset_list) as info:
+		info['cache_hit'] = (asset_type, asset_list) in RESOLUTION_CACHE
+		attribute = 'assets_emitted_' + asset_type
+		emitted = getattr(request, attribute, 0)
+		output = emit_assets(request, asset_type, get_asset_sources(asset_type, asset_list))
+		emitted = getattr(request, attribute, 0) & ~emitted
+		info['emitted'] = [name for name, index in ASSET_IDS.items() if emitted >> index & 1]
+	return output
 
 
 def assets_by_type(context, asset_type, *asset_list):
-	unused = get_or_create_unused_assets(context, asset_type)
-	if USE_TEMPLATES or asset_type not in ('css', 'js'):
-		render = lambda context: render_to_string("assets_manager/" + asset_type + ".html", context)
-	else:
-		render = render_css if asset_type == 'css' else render_js
-
-	return ''.join(chain(*(get_asset_sources(asset, unused, asset_type, render) for asset in asset_list)))
+	request = get_render_request(context)
+	if stage_finished.receivers:
+		return emit_measured_assets(request, asset_type, asset_list)
+	return emit_assets(request, asset_type, get_asset_sources(asset_type, asset_list))
 
 
 @register.simple_tag(takes_context=True)
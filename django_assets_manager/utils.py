@@ -1,20 +1,172 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
 import os
+import struct
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from pathlib import Path
 
 from django.conf import settings
 from django.contrib.staticfiles import finders
+from django.core.exceptions import ImproperlyConfigured
+
+from .signals import measure
+
+
+# umask can't be read without setting it, read once before threads are started
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 
 def find_file(path):
 	return finders.find(path)
 
 
+def set_default_mode(path):
+	# mkstemp creates files readable only by owner
+	os.chmod(path, 0o666 & ~UMASK)
+
+
+class StaticIndex:
+	# files of FileSystemFinder and AppDirectoriesFinder indexed with single walk
+	def __init__(self):
+		self.files = None
+
+	def build(self):
+		self.files = {}
+		for finder in finders.get_finders():
+			if isinstance(finder, finders.FileSystemFinder):
+				roots = finder.locations
+			elif isinstance(finder, finders.AppDirectoriesFinder):
+				roots = [('', finder.storages[app].location) for app in finder.apps]
+			else:
+				# other finders could shadow files of following finders
+				break
+			for prefix, root in roots:
+				self.scan(root, prefix + '/' if prefix else '')
+
+	def scan(self, root, prefix):
+		directories = [(root, prefix)]
+		while directories:
+			directory, dir_prefix = directories.pop()
+			try:
+				entries = list(os.scandir(directory))
+			except OSError:
+				continue
+			for entry in entries:
+				# symlinked directories are resolved by finders
+				if entry.is_dir(follow_symlinks=False):
+					directories.append((entry.path, dir_prefix + entry.name + '/'))
+				else:
+					self.files.setdefault(dir_prefix + entry.name, entry.path)
+
+	def find(self, path):
+		if self.files is None:
+			self.build()
+		filename = self.files.get(path)
+		if filename is None:
+			filename = find_file(path)
+		return filename
+
+
 def to_localfile(path) -> Path:
 	return Path.joinpath(Path(settings.STATICFILES_DIRS[0]), path)
 
 
+def get_file_hash(path):
+	digest = hashlib.sha256()
+	with open(path, 'rb') as fp:
+		for chunk in iter(lambda: fp.read(65536), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+def get_file_stat(path):
+	stat = os.stat(path)
+	return [stat.st_size, stat.st_mtime_ns]
+
+
+def write_if_changed(path, content):
+	path = Path(path)
+	try:
+		if path.read_text() == content:
+			return False
+	except OSError:
+		pass
+	path.parent.mkdir(parents=True, exist_ok=True)
+	path.write_text(content)
+	return True
+
+
+def get_image_cache_path():
+	path = getattr(settings, 'ASSETS_MANAGER_IMAGE_CACHE', None)
+	if path is None:
+		return to_localfile('.assets_manager_images.json')
+	return path or None
+
+
+class ImageMetadataCache:
+	VERSION = 1
+
+	def __init__(self, path=None):
+		self.path = path
+		self.entries = None
+		self.changed = False
+
+	def load(self):
+		self.entries = {}
+		if self.path is None:
+			return
+		try:
+			with open(self.path, 'r') as fp:
+				data = json.load(fp)
+		except (OSError, ValueError):
+			return
+		if isinstance(data, dict) and data.get('version') == self.VERSION:
+			self.entries = data.get('images', {})
+
+	def save(self):
+		if self.path is None or not self.changed:
+			return
+		path = Path(self.path)
+		path.parent.mkdir(parents=True, exist_ok=True)
+		tmp_path = path.with_name(path.name + '.tmp')
+		tmp_path.write_text(json.dumps({'version': self.VERSION, 'images': self.entries}, sort_keys=True))
+		os.replace(tmp_path, path)
+		self.changed = False
+
+	def get(self, filename):
+		from PIL import Image
+		if self.entries is None:
+			self.load()
+		filename = str(filename)
+		stat = os.stat(filename)
+		entry = self.entries.get(filename)
+		if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+			return entry
+
+		with Image.open(filename) as image:
+			width, height = image.size
+			if 'A' in image.getbands() or 'transparency' in image.info:
+				bbox = image.convert('RGBA').getchannel('A').getbbox()
+			else:
+				bbox = (0, 0, width, height)
+		entry = {
+			'size': stat.st_size,
+			'mtime': stat.st_mtime_ns,
+			'width': width,
+			'height': height,
+			'hash': get_file_hash(filename),
+			'bbox': list(bbox) if bbox else None,
+		}
+		self.entries[filename] = entry
+		self.changed = True
+		return entry
+
+
 class NoSpaceError(RuntimeError):
 	pass
 
@@ -23,15 +175,24 @@ class AssetNotFoundError(RuntimeError):
 	pass
 
 
+def next_power_of_two(value):
+	return 1 << max(value - 1, 0).bit_length()
+
+
+class SkylineSegment:
+	__slots__ = ('x', 'y', 'width')
+
+	def __init__(self, x, y, width):
+		self.x = x
+		self.y = y
+		self.width = width
+
+
 class Packer:
 	def __init__(self, width, height):
-		self.root = {
-			'pos': (0, 0),
-			'size': (width + 1, height + 1), # 1px gap
-			'used': False,
-			'down': None,
-			'right': None
-		}
+		self.width = width + 1 # 1px gap
+		self.height = height + 1
+		self.skyline = [SkylineSegment(0, 0, self.width)]
 
 	def fit(self, blocks):
 		repeat_mode = None
@@ -52,103 +213,443 @@ class Packer:
 				else:
 					raise NoSpaceError('Can not mix repeat-x and repeat-y for %s' % block['name'])
 
-		for block in blocks:
-			if block['mode'] == 'no-repeat':
-				self.fit_block(block)
+		self.skyline = [SkylineSegment(0, 0, self.width)]
+		for block in self.sort_blocks(blocks):
+			self.fit_block(block)
+
+	@staticmethod
+	def sort_blocks(blocks):
+		blocks = [block for block in blocks if block['mode'] == 'no-repeat']
+		blocks.sort(key=lambda block: (block['height'], block['width']), reverse=True)
+		return blocks
 
 	def fit_block(self, block):
-		size = (block['width'] + 1, block['height'] + 1) # 1px gap
-		node = self.find_node(self.root, size)
-		if node is None:
+		w, h = (block['width'] + 1, block['height'] + 1) # 1px gap
+		skyline = self.skyline
+		count = len(skyline)
+		max_x = self.width - w
+		best_top = self.height + 1
+		best_index = None
+
+		# bottom-left rule: lowest top edge, then leftmost position
+		for i in range(count):
+			segment = skyline[i]
+			x = segment.x
+			if x > max_x:
+				break
+			y = segment.y
+			if y + h >= best_top:
+				continue
+			right = x + w
+			j = i + 1
+			while j < count and skyline[j].x < right:
+				if skyline[j].y > y:
+					y = skyline[j].y
+				j += 1
+			if y + h < best_top:
+				best_top = y + h
+				best_index = i
+
+		if best_index is None:
 			raise NoSpaceError('Block %s' % block['name'])
-		self.split_node(node, size)
-		node['used'] = block['name']
-		block['pos'] = node['pos']
+
+		x = skyline[best_index].x
+		self.add_skyline_level(best_index, x, best_top, w)
+		block['pos'] = (x, best_top - h)
 		block['size'] = (block['width'], block['height'])
 
+	def add_skyline_level(self, index, x, y, width):
+		skyline = self.skyline
+		right = x + width
+		skyline.insert(index, SkylineSegment(x, y, width))
+
+		i = index + 1
+		while i < len(skyline):
+			segment = skyline[i]
+			segment_right = segment.x + segment.width
+			if segment_right <= right:
+				del skyline[i]
+				continue
+			if segment.x < right:
+				segment.width = segment_right - right
+				segment.x = right
+			break
+
+		if index + 1 < len(skyline) and skyline[index + 1].y == y:
+			skyline[index].width += skyline[index + 1].width
+			del skyline[index + 1]
+		if index > 0 and skyline[index - 1].y == y:
+			skyline[index - 1].width += skyline[index].width
+			del skyline[index]
+
 	def fit_block_repeat_x(self, block):
-		self.root['size'] = (self.root['size'][0], self.root['size'][1] - block['height'] - 1)
-		if self.root['size'][1] <= -1:
+		self.height -= block['height'] + 1
+		if self.height <= -1:
 			raise NoSpaceError('Block %s' % block['name'])
 
-		block['pos'] = (0, self.root['size'][1])
-		block['size'] = (self.root['size'][0] - 1, block['height'])
+		block['pos'] = (0, self.height)
+		block['size'] = (self.width - 1, block['height'])
 
 	def fit_block_repeat_y(self, block):
-		self.root['size'] = (self.root['size'][0] - block['width'] - 1, self.root['size'][1])
-		if self.root['size'][0] <= -1:
+		self.width -= block['width'] + 1
+		if self.width <= -1:
 			raise NoSpaceError('Block %s' % block['name'])
 
-		block['pos'] = (self.root['size'][0], 0)
-		block['size'] = (block['width'], self.root['size'][1] - 1)
-
-	def find_node(self, root, size):
-		#if not root:
-		#	return None
-
-		if root['used']:
-			return self.find_node(root['right'], size) or self.find_node(root['down'], size)
-
-		w, h = size
-		root_w, root_h = root['size']
-		if w <= root_w and h <= root_h:
-			return root
+		block['pos'] = (self.width, 0)
+		block['size'] = (block['width'], self.height - 1)
 
-		return None
+	@classmethod
+	def find_size(cls, blocks, power_of_two=False, max_size=16384):
+		for block in blocks:
+			block.setdefault('mode', 'no-repeat')
+		normal = cls.sort_blocks(blocks)
+		strips_x = sum(block['height'] + 1 for block in blocks if block['mode'] == 'repeat-x')
+		strips_y = sum(block['width'] + 1 for block in blocks if block['mode'] == 'repeat-y')
+		min_inner_width = max((block['width'] + 1 for block in normal), default=1)
+		area = sum((block['width'] + 1) * (block['height'] + 1) for block in normal)
+
+		# canvas width = root width (inner width + strips) - 1px gap
+		lower = max(min_inner_width + strips_y - 1, 1)
+		if power_of_two:
+			lower = next_power_of_two(lower)
+		if lower > max_size:
+			raise NoSpaceError('Sprites wider than %dpx' % max_size)
+
+		def clamp(width):
+			if power_of_two:
+				width = next_power_of_two(width)
+			return min(max(width, lower), max_size)
+
+		def get_height(width):
+			packer = cls(width - strips_y, max_size - strips_x)
+			try:
+				for block in normal:
+					packer.fit_block(block)
+			except NoSpaceError:
+				return None
+			used_height = max((block['pos'][1] + block['height'] + 1 for block in normal), default=0)
+			height = max(used_height + strips_x - 1, 1)
+			if power_of_two:
+				height = next_power_of_two(height)
+			return height if height <= max_size else None
+
+		# few packs converging to square sheet, width is moved to geometric mean of last size
+		sizes = {}
+		width = clamp(int((area + strips_x * strips_y) ** 0.5))
+		while width not in sizes and len(sizes) < 8:
+			height = sizes[width] = get_height(width)
+			if height is None:
+				width = clamp(width * 2)
+			else:
+				width = clamp(int((width * height) ** 0.5 + 0.5))
+		sizes = [(width, height) for width, height in sizes.items() if height is not None]
+		if not sizes:
+			raise NoSpaceError('Sprites don\'t fit to %dpx sheet' % max_size)
+
+		# squarest sheet with area close to smallest area
+		min_area = min(width * height for width, height in sizes)
+		sizes = [size for size in sizes if size[0] * size[1] <= min_area * 1.1]
+		return min(sizes, key=lambda size: (max(size) / min(size), size[0] * size[1]))
+
+	@classmethod
+	def pack_pages(cls, blocks, width, height, power_of_two=False):
+		if power_of_two:
+			# rounded pages must not exceed page size
+			width, height = (1 << (width.bit_length() - 1), 1 << (height.bit_length() - 1))
+		for block in blocks:
+			block.setdefault('mode', 'no-repeat')
+		strips_x = [block for block in blocks if block['mode'] == 'repeat-x']
+		strips_y = [block for block in blocks if block['mode'] == 'repeat-y']
+		if strips_x and strips_y:
+			raise NoSpaceError('Can not mix repeat-x and repeat-y for %s' % strips_y[0]['name'])
+		reserved_width = sum(block['width'] + 1 for block in strips_y)
+		reserved_height = sum(block['height'] + 1 for block in strips_x)
+		if reserved_width > width or reserved_height > height:
+			raise NoSpaceError('Strips of %s' % (strips_x or strips_y)[0]['name'])
+
+		# strips are placed on first page, other blocks fill first page with free space
+		packers = [cls(width - reserved_width, height - reserved_height)]
+		pages = [[]]
+		for block in cls.sort_blocks(blocks):
+			for packer, page in zip(packers, pages):
+				try:
+					packer.fit_block(block)
+				except NoSpaceError:
+					continue
+				page.append(block)
+				break
+			else:
+				packer = cls(width, height)
+				packer.fit_block(block)
+				packers.append(packer)
+				pages.append([block])
+
+		result = []
+		for number, page in enumerate(pages):
+			strips = (reserved_width, reserved_height) if number == 0 else (0, 0)
+			page_width = max(max((block['pos'][0] + block['width'] + 1 for block in page), default=0) + strips[0] - 1, 1)
+			page_height = max(max((block['pos'][1] + block['height'] + 1 for block in page), default=0) + strips[1] - 1, 1)
+			if power_of_two:
+				page_width, page_height = (next_power_of_two(page_width), next_power_of_two(page_height))
+			if number == 0:
+				packer = cls(page_width, page_height)
+				for block in strips_x:
+					packer.fit_block_repeat_x(block)
+				for block in strips_y:
+					packer.fit_block_repeat_y(block)
+				page = page + strips_x + strips_y
+			for block in page:
+				block['page'] = number
+			result.append(((page_width, page_height), page))
+		return result
+
+
+def init_worker():
+	if not settings.configured: # pragma: no cover
+		import django
+		django.setup()
+
+
+def generate_sprite(sprite_conf):
+	generator = SpriteGenerator(sprite_conf['output'], (sprite_conf['width'], sprite_conf['height']), sprite_conf['ratio'], get_sprite_outputs(sprite_conf))
+	generator.generate(sprite_conf['images'])
+	return sprite_conf
+
+
+def get_format_output(output, image_format):
+	return os.path.splitext(output)[0] + '.' + image_format.lower()
+
+
+def get_sprite_outputs(sprite_conf):
+	png_options = {}
+	if sprite_conf.get('optimize'):
+		png_options['optimize'] = True
+	colors = sprite_conf.get('quantize')
+	if colors is True:
+		colors = 256
+	if colors:
+		if not isinstance(colors, int) or not 2 <= colors <= 256:
+			raise ImproperlyConfigured("Sprite %s: quantize must be True or number of colors from 2 to 256" % sprite_conf['output'])
+		png_options['quantize'] = colors
+	outputs = [(sprite_conf['output'], 'PNG', png_options)]
+	formats = sprite_conf.get('formats', {})
+	if not isinstance(formats, dict):
+		formats = {image_format: {} for image_format in formats}
+	for image_format, options in formats.items():
+		outputs.append((get_format_output(sprite_conf['output'], image_format), image_format.upper(), dict(options)))
+	return outputs
+
+
+class PngWriter:
+	# writes RGBA PNG in horizontal bands, whole image is never held in memory
+	def __init__(self, path, width, height):
+		self.path = Path(path)
+		self.width = width
+		self.height = height
+		self.fp = None
+		self.tmp_path = None
+		self.compressor = None
+
+	def __enter__(self):
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		fd, self.tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix='.' + self.path.name, suffix='.tmp')
+		self.fp = os.fdopen(fd, 'wb')
+		self.compressor = zlib.compressobj(6)
+		self.fp.write(b'\x89PNG\r\n\x1a\n')
+		# 8 bits per channel, RGBA, no interlace
+		self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 6, 0, 0, 0))
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		try:
+			if exc_type is None:
+				self.write_chunk(b'IDAT', self.compressor.flush())
+				self.write_chunk(b'IEND', b'')
+		finally:
+			self.fp.close()
+		if exc_type is None:
+			set_default_mode(self.tmp_path)
+			os.replace(self.tmp_path, self.path)
+		else:
+			os.unlink(self.tmp_path)
 
-	def split_node(self, root, size):
-		root_w, root_h = root['size']
-		w, h = size
-		x, y = root['pos']
+	def write_chunk(self, chunk_type, data):
+		self.fp.write(struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data)))
 
-		root['down'] =  {'pos': (x, y + h), 'size': (root_w, root_h - h), 'used': False, 'down': None, 'right': None}
-		root['right'] = {'pos': (x + w, y), 'size': (root_w - w, h), 'used': False, 'down': None, 'right': None}
+	def write(self, band):
+		data = band.tobytes()
+		stride = self.width * 4
+		# filter type 0 before every row
+		rows = b''.join(b'\x00' + data[offset:offset + stride] for offset in range(0, len(data), stride))
+		compressed = self.compressor.compress(rows)
+		if compressed:
+			self.write_chunk(b'IDAT', compressed)
 
 
 class SpriteGenerator:
-	def __init__(self, filename, size, pixel_ratio):
-		from PIL import Image
+	def __init__(self, filename, size, pixel_ratio, outputs=None):
 		self.filename = filename
 		self.size = size
 		self.pixel_ratio = pixel_ratio
-		self.out_image = Image.new('RGBA', (size[0] * pixel_ratio, size[1] * pixel_ratio))
+		self.outputs = outputs or [(filename, 'PNG', {})]
+		self.out_image = None
 
 	def generate(self, images):
-		for img in images:
-			self.paste_image(img)
-		output_filename = to_localfile(self.filename)
-		output_filename.parent.mkdir(parents=True, exist_ok=True)
-		self.out_image.save(output_filename)
+		from PIL import Image
+		width, height = (self.size[0] * self.pixel_ratio, self.size[1] * self.pixel_ratio)
+		max_pixels = getattr(settings, 'ASSETS_MANAGER_SPRITES_MAX_PIXELS', 4096 * 4096)
+		filename, image_format, options = self.outputs[0]
+		# only plain PNG can be encoded without whole canvas
+		if width * height > max_pixels and len(self.outputs) == 1 and image_format == 'PNG' and not options.get('quantize'):
+			with measure('compose', output=self.filename, images=len(images), banded=True):
+				self.generate_banded(images, to_localfile(filename), max(max_pixels // width, 1))
+			return
+
+		with measure('compose', output=self.filename, images=len(images)):
+			self.out_image = Image.new('RGBA', (width, height))
+			for src_filename, group in self.group_by_source(images).items():
+				with Image.open(src_filename) as in_image:
+					for image in group:
+						self.paste_image(self.out_image, in_image, image)
+		if len(self.outputs) > 1:
+			# encoders release GIL
+			with ThreadPoolExecutor(max_workers=len(self.outputs)) as executor:
+				list(executor.map(self.encode, self.outputs))
+		else:
+			self.encode(self.outputs[0])
+		self.out_image.close()
+		self.out_image = None
 
-	def paste_image(self, image):
+	def generate_banded(self, images, output_filename, band_height):
 		from PIL import Image
-		in_image = Image.open(find_file(image['src']))
+		width, height = (self.size[0] * self.pixel_ratio, self.size[1] * self.pixel_ratio)
+		sources = self.group_by_source(images)
+		# decoded sources are kept until last band using them
+		decoded = {}
+		try:
+			with PngWriter(output_filename, width, height) as writer:
+				for top in range(0, height, band_height):
+					with Image.new('RGBA', (width, min(band_height, height - top))) as band:
+						for src_filename, group in sources.items():
+							group = [image for image in group if self.intersects(image, top, band.height)]
+							if not group:
+								continue
+							if src_filename not in decoded:
+								with Image.open(src_filename) as in_image:
+									decoded[src_filename] = in_image.convert('RGBA')
+							for image in group:
+								self.paste_image(band, decoded[src_filename], image, top)
+						for src_filename in [src_filename for src_filename in decoded if self.get_bottom(sources[src_filename], height) <= top + band.height]:
+							decoded.pop(src_filename).close()
+						writer.write(band)
+		finally:
+			for in_image in decoded.values():
+				in_image.close()
+
+	def get_bottom(self, images, height):
+		# repeat-y strips are used by all bands
+		return max(height if image['mode'] == 'repeat-y' else (image['pos'][1] + image['height']) * self.pixel_ratio for image in images)
+
+	def group_by_source(self, images):
+		# every source is decoded once
+		sources = {}
+		for image in images:
+			sources.setdefault(image['filename'], []).append(image)
+		return sources
+
+	def intersects(self, image, top, height):
+		if image['mode'] == 'repeat-y':
+			return True
+		y = image['pos'][1] * self.pixel_ratio
+		return y < top + height and y + image['height'] * self.pixel_ratio > top
+
+	def get_strip(self, in_image, image, length):
+		from PIL import Image
+		horizontal = image['mode'] == 'repeat-x'
+		tile_size = (image['width'] * self.pixel_ratio, image['height'] * self.pixel_ratio)
+		step = tile_size[0] if horizontal else tile_size[1]
+		strip = Image.new('RGBA', (length, tile_size[1]) if horizontal else (tile_size[0], length))
+		strip.paste(in_image.convert('RGBA').crop((0, 0) + tile_size), (0, 0))
+		# filled part is doubled, number of pastes grows with log of length
+		while step < length:
+			box = (0, 0, step, tile_size[1]) if horizontal else (0, 0, tile_size[0], step)
+			strip.paste(strip.crop(box), (step, 0) if horizontal else (0, step))
+			step *= 2
+		return strip
+
+	def paste_image(self, target, in_image, image, top=0):
+		x, y = (image['pos'][0] * self.pixel_ratio, image['pos'][1] * self.pixel_ratio - top)
 		if image['mode'] == 'repeat-x':
-			w = image['width']
-			for i in range((self.size[0] + w - 1) // w):
-				self.out_image.paste(in_image, (i * w * self.pixel_ratio, image['pos'][1] * self.pixel_ratio))
+			with self.get_strip(in_image, image, target.width) as strip:
+				target.paste(strip, (0, y))
 		elif image['mode'] == 'repeat-y':
-			h = image['height']
-			for i in range((self.size[1] + h - 1) // h):
-				self.out_image.paste(in_image, (image['pos'][0] * self.pixel_ratio, i * h * self.pixel_ratio))
+			# strip starts at tile boundary above the band
+			offset = top % (image['height'] * self.pixel_ratio)
+			with self.get_strip(in_image, image, target.height + offset) as strip:
+				target.paste(strip, (x, -offset))
 		else:
-			self.out_image.paste(in_image, (image['pos'][0] * self.pixel_ratio, image['pos'][1] * self.pixel_ratio))
+			target.paste(in_image, (x, y))
+
+	def encode(self, output):
+		from PIL import Image
+		filename, image_format, options = output
+		with measure('encode', output=filename, format=image_format):
+			image = self.out_image
+			options = dict(options)
+			colors = options.pop('quantize', None)
+			if colors:
+				image = image.quantize(colors, method=Image.Quantize.FASTOCTREE)
+			output_filename = to_localfile(filename)
+			output_filename.parent.mkdir(parents=True, exist_ok=True)
+			image.save(output_filename, image_format, **options)
 
 	def generate_scss(self, sprites, sprite_configs):
+		with measure('scss', output=sprites['scss_output']):
+			self.write_scss(sprites, sprite_configs)
+
+	def write_scss(self, sprites, sprite_configs):
+		# configs of every pixel ratio grouped by page
+		pages = {}
+		for config in sprite_configs:
+			pages.setdefault(config.get('page', 0), []).append(config)
+
+		metadata = self.get_page_metadata(pages[0])
+		if sprites.get('page_size'):
+			metadata['_pages'] = '(' + ', '.join(
+				'%d: (%s)' % (number, ', '.join(k + ': ' + v for k, v in self.get_page_metadata(configs).items()))
+				for number, configs in pages.items()
+			) + ')'
+
+		content = '$' + sprites['name'] + ': (\n'
+		for k, v in metadata.items():
+			content += k + ': ' + v + ',\n'
+		content += ',\n'.join([self.generate_image_scss(img) for configs in pages.values() for img in configs[0]['images']])
+		content += '\n);'
+		write_if_changed(to_localfile(sprites['scss_output']), content)
+
+	def get_page_metadata(self, sprite_configs):
 		metadata = {
-			'_w': str(sprites['width']) + 'px',
-			'_h': str(sprites['height']) + 'px',
+			'_w': str(sprite_configs[0]['width']) + 'px',
+			'_h': str(sprite_configs[0]['height']) + 'px',
 		}
 		metadata['_size'] = metadata['_w'] + ' ' + metadata['_h']
 		metadata['_ratio'] = '(' + (' '.join(str(config['ratio']) for config in sprite_configs)) + ')'
 		metadata['_url'] = '(' + (' '.join('url(static("' + config['output'] + '"))' for config in sprite_configs)) + ')'
 
-		f = open(to_localfile(sprites['scss_output']), 'w+')
-		f.write('$' + sprites['name'] + ': (\n')
-		for k, v in metadata.items():
-			f.write(k + ': ' + v + ',\n')
-		f.write(',\n'.join([self.generate_image_scss(img) for img in sprite_configs[0]['images']]))
-		f.write('\n);')
+		# format -> output for every ratio
+		alternates = {}
+		for config in sprite_configs:
+			for output, image_format, __ in get_sprite_outputs(config)[1:]:
+				alternates.setdefault(image_format.lower(), []).append(output)
+		for image_format, outputs in alternates.items():
+			metadata['_url-' + image_format] = '(' + (' '.join('url(static("' + output + '"))' for output in outputs)) + ')'
+		if alternates:
+			image_set = []
+			for image_format, outputs in list(alternates.items()) + [('png', [config['output'] for config in sprite_configs])]:
+				for config, output in zip(sprite_configs, outputs):
+					image_set.append('url(static("%s")) type("image/%s") %sx' % (output, image_format, config['ratio']))
+			metadata['_image-set'] = 'image-set(' + ', '.join(image_set) + ')'
+		return metadata
 
 	def generate_image_scss(self, image):
 		w, h = (str(image['width']) + 'px', str(image['height']) + 'px')
@@ -162,89 +663,209 @@ class SpriteGenerator:
 			'size': w + ' ' + h,
 			'offset': '-' + x + ' -' + y,
 		}
-		return '{name}: (w: {w}, h: {h}, x: {x}, y: {y}, size: {size}, offset: {offset})'.format(**ctx)
+		scss = '{name}: (w: {w}, h: {h}, x: {x}, y: {y}, size: {size}, offset: {offset}'.format(**ctx)
+		if 'page' in image:
+			scss += ', page: %d' % image['page']
+		return scss + ')'
+
+
+# (manifest path, fingerprint) -> stats of unchanged sources found by check
+CHECKED_SOURCE_STATS = {}
 
 
 class SpriteCompiler:
-	def compile(self, sprites):
-		for sprite_def in sprites:
-			self.pack_sprites(sprite_def)
+	MANIFEST_VERSION = 1
 
-	def pack_sprites(self, sprites):
-		from PIL import Image
-		sizes = ((1, ''),)
-		sizes += tuple(sprites.get('extra_sizes', ()))
+	def __init__(self, jobs=1, force=False, images=None):
+		self.jobs = jobs
+		self.force = force
+		self.images = ImageMetadataCache(get_image_cache_path()) if images is None else images
+		self.static_index = StaticIndex()
 
-		for img in sprites['images']:
-			if not 'width' in img or not 'height' in img:
-				src_filename = find_file(img['src'])
-				if src_filename is None:
-					raise AssetNotFoundError("File %s not found" % img['src'])
-				(width, height) = Image.open(src_filename).size
-				img['width'] = width
-				img['height'] = height
+	def compile(self, sprites):
+		if self.jobs > 1:
+			from concurrent.futures import ProcessPoolExecutor
+			with ProcessPoolExecutor(max_workers=self.jobs, initializer=init_worker) as executor:
+				self.compile_sprites(sprites, executor.map)
+		else:
+			self.compile_sprites(sprites, map)
 
+	def compile_sprites(self, sprites, map_func):
+		jobs = []
+		for sprite_def in sprites:
+			sources = self.get_sources(sprite_def)
+			fingerprint = self.get_fingerprint(sprite_def, sources)
+			if not self.force and not self.fingerprint_changed(sprite_def, fingerprint):
+				# touched sources without change, new stats restore fast path of check
+				manifest = self.read_manifest(sprite_def)
+				manifest['sources'] = self.get_source_stats(sources)
+				self.save_manifest(sprite_def, manifest)
+				continue
+			sprite_configs = self.get_sprite_configs(sprite_def, sources)
+			sheet = {'sprites': sprite_def, 'sources': sources, 'fingerprint': fingerprint, 'count': len(sprite_configs)}
+			jobs.extend((sheet, sprite_conf) for sprite_conf in sprite_configs)
+		self.images.save()
+
+		# results are returned in order, all ratios of sheet are consecutive
 		sprite_configs = []
-		for size, suffix in sizes:
-			sprite_conf = self.preprocess_pixel_ratio(sprites, (size, suffix))
-			packer = Packer(sprite_conf['width'], sprite_conf['height'])
-			packer.fit(sprite_conf['images'])
-			generator = SpriteGenerator(sprite_conf['output'], (sprite_conf['width'], sprite_conf['height']), size)
-			generator.generate(sprite_conf['images'])
+		for (sheet, __), sprite_conf in zip(jobs, map_func(generate_sprite, [job[1] for job in jobs])):
 			sprite_configs.append(sprite_conf)
-		generator.generate_scss(sprites, sprite_configs)
+			if len(sprite_configs) == sheet['count']:
+				SpriteGenerator(sprite_conf['output'], (sprite_conf['width'], sprite_conf['height']), 1).generate_scss(sheet['sprites'], sprite_configs)
+				self.write_manifest(sheet['sprites'], sheet['sources'], sheet['fingerprint'], [output for config in sprite_configs for output, __, __ in get_sprite_outputs(config)])
+				sprite_configs = []
 
-	def add_suffix(self, name, suffix):
-		return suffix.join(os.path.splitext(name))
+	def get_sizes(self, sprites):
+		return ((1, ''),) + tuple(sprites.get('extra_sizes', ()))
 
-	def preprocess_pixel_ratio(self, sprites, size):
-		ratio, suffix = size
+	def get_sprite_configs(self, sprites, sources):
 		sprites = deepcopy(sprites)
-		del sprites['extra_sizes']
-		sprites['output'] = self.add_suffix(sprites['output'], suffix)
-		sprites['ratio'] = ratio
-		sprites['suffix'] = suffix
+		sources = dict(sources)
 
-		for image in sprites['images']:
-			image['original'] = image['name']
-			image['name'] = image['name'] + suffix
-			image['src'] = self.add_suffix(image['src'], suffix)
+		for img in sprites['images']:
+			if not 'width' in img or not 'height' in img:
+				metadata = self.images.get(sources[img['src']])
+				img['width'] = metadata['width']
+				img['height'] = metadata['height']
+
+		if sprites.get('page_size'):
+			return [self.preprocess_pixel_ratio(page, size, sources) for page in self.get_pages(sprites) for size in self.get_sizes(sprites)]
+
+		if not 'width' in sprites or not 'height' in sprites:
+			with measure('find_size', output=sprites['output'], images=len(sprites['images'])):
+				sprites['width'], sprites['height'] = Packer.find_size(list(sprites['images']), sprites.get('power_of_two', False), getattr(settings, 'ASSETS_MANAGER_SPRITES_MAX_SIZE', 16384))
+
+		# layout of 1x sheet is scaled for every pixel ratio
+		with measure('pack', output=sprites['output'], images=len(sprites['images'])):
+			Packer(sprites['width'], sprites['height']).fit(sprites['images'])
+
+		return [self.preprocess_pixel_ratio(sprites, size, sources) for size in self.get_sizes(sprites)]
+
+	def get_pages(self, sprites):
+		with measure('pack', output=sprites['output'], images=len(sprites['images'])) as info:
+			width, height = sprites['page_size']
+			pages = Packer.pack_pages(list(sprites['images']), width, height, sprites.get('power_of_two', False))
+			info['pages'] = len(pages)
+		return [
+			# first page keeps name of output
+			dict(sprites, output=self.add_suffix(sprites['output'], '-%d' % number if number else ''), page=number, width=size[0], height=size[1], images=images)
+			for number, (size, images) in enumerate(pages)
+		]
+
+	def get_sources(self, sprites):
+		sources = []
+		missing = []
+		for __, suffix in self.get_sizes(sprites):
+			for img in sprites['images']:
+				src = self.add_suffix(img['src'], suffix)
+				src_filename = self.static_index.find(src)
+				if src_filename is None:
+					missing.append(src)
+				else:
+					sources.append((src, src_filename))
+		if missing:
+			raise AssetNotFoundError("File %s not found" % ', '.join(missing))
+		return sources
+
+	def get_config_hash(self, sprites):
+		return hashlib.sha256(json.dumps([self.MANIFEST_VERSION, sprites], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+	def get_fingerprint(self, sprites, sources):
+		digest = hashlib.sha256(self.get_config_hash(sprites).encode('utf-8'))
+		for src, src_filename in sources:
+			digest.update(src.encode('utf-8'))
+			digest.update(self.images.get(src_filename)['hash'].encode('utf-8'))
+		return digest.hexdigest()
+
+	def get_source_stats(self, sources):
+		# paths relative to static roots are resolved when recorded filename doesn't exist
+		stats = {}
+		for src, src_filename in sources:
+			stats[src] = get_file_stat(src_filename) + [str(src_filename)]
+		return stats
+
+	def stat_source(self, src, stat):
+		if len(stat) > 2:
+			try:
+				return os.stat(stat[2])
+			except OSError:
+				pass
+		src_filename = self.static_index.find(src)
+		if src_filename is None:
+			return None
+		return os.stat(src_filename)
 
-		return sprites
+	def get_manifest_path(self, sprites):
+		output = sprites['output']
+		return to_localfile(os.path.join(os.path.dirname(output), '.' + os.path.basename(output) + '.json'))
 
-	def get_mtime(self, filename):
+	def read_manifest(self, sprites):
 		try:
-			return os.path.getmtime(filename)
-		except OSError:
+			with open(self.get_manifest_path(sprites), 'r') as fp:
+				return json.load(fp)
+		except (OSError, ValueError):
 			return None
 
-	def get_dependencies(self, sprites):
-		dependencies = {}
-
-		for sprite_def in sprites:
-			sizes = ((1, ''),)
-			sizes += tuple(sprite_def.get('extra_sizes', ()))
-
-			for size, suffix in sizes:
-				sprite_conf = self.preprocess_pixel_ratio(sprite_def, (size, suffix))
-				deps = []
-				dependencies[sprite_conf['output']] = {
-					'ts': self.get_mtime(to_localfile(sprite_conf['output'])),
-					'dep': deps,
-				}
-				for img in sprite_conf['images']:
-					src_filename = find_file(img['src'])
-					if src_filename is None:
-						raise AssetNotFoundError("File %s not found" % img['src'])
-					deps.append((img['src'], self.get_mtime(find_file(img['src']))))
-
-		return dependencies
-
-	def recompilation_needed(self, sprites):
-		deps = self.get_dependencies(sprites)
-		for dep in deps.values():
-			if dep['ts'] is None:
-				return True
-			if any(img[1] > dep['ts'] for img in dep['dep']):
+	def save_manifest(self, sprites, manifest):
+		write_if_changed(self.get_manifest_path(sprites), json.dumps(manifest, indent=1, sort_keys=True))
+
+	def write_manifest(self, sprites, sources, fingerprint, outputs):
+		self.save_manifest(sprites, {
+			'config': self.get_config_hash(sprites),
+			'fingerprint': fingerprint,
+			'outputs': outputs + [sprites['scss_output']],
+			'sources': self.get_source_stats(sources),
+		})
+
+	def outputs_exist(self, manifest):
+		return all(to_localfile(output).exists() for output in manifest['outputs'])
+
+	def fingerprint_changed(self, sprites, fingerprint):
+		manifest = self.read_manifest(sprites)
+		if manifest is None or manifest.get('fingerprint') != fingerprint:
+			return True
+		return not self.outputs_exist(manifest)
+
+	def manifest_changed(self, sprites):
+		# fast path, only stats of source files recorded in manifest are compared
+		manifest = self.read_manifest(sprites)
+		if manifest is None or manifest.get('config') != self.get_config_hash(sprites):
+			return True
+		stats = CHECKED_SOURCE_STATS.get((str(self.get_manifest_path(sprites)), manifest.get('fingerprint')), manifest.get('sources', {}))
+		for src, stat in stats.items():
+			current = self.stat_source(src, stat)
+			if current is None or [current.st_size, current.st_mtime_ns] != stat[:2]:
 				return True
+		return not self.outputs_exist(manifest)
+
+	def sheet_outdated(self, sprites, full=False):
+		if not full and not self.manifest_changed(sprites):
+			return False
+		sources = self.get_sources(sprites)
+		fingerprint = self.get_fingerprint(sprites, sources)
+		if self.fingerprint_changed(sprites, fingerprint):
+			return True
+		if not full:
+			# sources were touched without change, checks don't write files, new stats are kept in memory
+			CHECKED_SOURCE_STATS[(str(self.get_manifest_path(sprites)), fingerprint)] = self.get_source_stats(sources)
 		return False
+
+	def recompilation_needed(self, sprites, full=False):
+		return any(self.sheet_outdated(sprite_def, full) for sprite_def in sprites)
+
+	def add_suffix(self, name, suffix):
+		return suffix.join(os.path.splitext(name))
+
+	def preprocess_pixel_ratio(self, sprites, size, sources):
+		ratio, suffix = size
+		config = {key: value for key, value in sprites.items() if key not in ('extra_sizes', 'images')}
+		config['output'] = self.add_suffix(sprites['output'], suffix)
+		config['ratio'] = ratio
+		config['suffix'] = suffix
+		# packed positions are shared, only names and sources differ
+		config['images'] = []
+		for image in sprites['images']:
+			src = self.add_suffix(image['src'], suffix)
+			# workers don't search for sources again
+			config['images'].append(dict(image, original=image['name'], name=image['name'] + suffix, src=src, filename=str(sources[src])))
+		return config
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import importlib
+import os
+import sys
+
+import django
+
+
+SUITES = ('templates', 'sprites')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Run benchmarks")
+	parser.add_argument('suite', choices=SUITES)
+	parser.add_argument('--quick', action='store_true', help="Run only small benchmarks")
+	parser.add_argument('--output', help="Write results to JSON file")
+	parser.add_argument('--baseline', help="Compare results with JSON file written using --output")
+	parser.add_argument('--threshold', type=float, default=1.25, help="Maximal allowed ratio to baseline (default 1.25)")
+	args = parser.parse_args()
+
+	os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+	django.setup()
+	from tests import benchmarks
+	suite = importlib.import_module('tests.benchmarks.' + args.suite)
+
+	results = suite.run(quick=args.quick)
+	print(suite.format_results(results))
+	if args.output:
+		benchmarks.write_results(args.output, results)
+	if args.baseline:
+		regressions = benchmarks.compare_results(results, benchmarks.load_results(args.baseline), suite.METRICS, args.threshold)
+		for key, metric, old, new in regressions:
+			print("Regression %s %s: %s -> %s" % (key, metric, old, new))
+		sys.exit(bool(regressions))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import json
+import platform
+import time
+import tracemalloc
+
+import django
+
+
+def measure_peak_memory(func, *args):
+	tracemalloc.start()
+	try:
+		func(*args)
+		current, peak = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+	return current, peak
+
+
+def measure_time(func, *args):
+	start = time.perf_counter_ns()
+	func(*args)
+	return time.perf_counter_ns() - start
+
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def get_environment():
+	return {
+		'python': platform.python_version(),
+		'django': django.get_version(),
+		'machine': platform.machine(),
+	}
+
+
+def write_results(path, results):
+	with open(path, 'w') as fp:
+		json.dump({'environment': get_environment(), 'results': results}, fp, indent=1, sort_keys=True)
+
+
+def load_results(path):
+	with open(path, 'r') as fp:
+		return json.load(fp)['results']
+
+
+def compare_results(results, baseline, metrics, threshold):
+	regressions = []
+	for key, values in results.items():
+		if key not in baseline:
+			continue
+		for metric, higher_is_better in metrics:
+			old, new = baseline[key].get(metric), values.get(metric)
+			if not old or new is None:
+				continue
+			ratio = old / new if higher_is_better else new / old
+			if ratio > threshold:
+				regressions.append((key, metric, old, new))
+	return regressions
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+
+from django.test import override_settings
+from PIL import Image, ImageDraw
+
+from django_assets_manager.utils import ImageMetadataCache, Packer, SpriteCompiler, generate_sprite, init_worker, to_localfile
+
+from . import measure_time
+
+
+COUNTS = (50, 500, 2000)
+QUICK_COUNTS = (20, 100)
+ICON_SETS = ('uniform', 'power_law', 'strips', 'ratios')
+METRICS = (
+	('pack_ms', False),
+	('compose_ms', False),
+	('fill_ratio', True),
+	('png_bytes', False),
+	('peak_rss_kb', False),
+)
+
+
+def get_icon_sizes(icon_set, count, rng):
+	if icon_set == 'power_law':
+		sizes = []
+		for __ in range(count):
+			size = min(int(8 * rng.paretovariate(1.5)), 256)
+			sizes.append((size, max(min(int(size * rng.uniform(0.5, 2)), 256), 1)))
+		return sizes
+	if icon_set == 'ratios':
+		return [(24, 24)] * count
+	return [(32, 32)] * count
+
+
+def create_icon(path, width, height, rng):
+	image = Image.new('RGBA', (width, height))
+	draw = ImageDraw.Draw(image)
+	for __ in range(3):
+		color = tuple(rng.randrange(256) for __ in range(4))
+		x, y = rng.randrange(width), rng.randrange(height)
+		draw.ellipse((x // 2, y // 2, x, y), fill=color)
+	path.parent.mkdir(parents=True, exist_ok=True)
+	image.save(path)
+
+
+def generate_icon_set(icon_set, count, seed=0):
+	rng = random.Random(seed)
+	images = []
+	sizes = ((1, ''), (2, '@2x'), (3, '@3x')) if icon_set == 'ratios' else ((1, ''),)
+	for index, (width, height) in enumerate(get_icon_sizes(icon_set, count, rng)):
+		images.append({'name': 'icon%d' % index, 'src': 'icons/icon%d.png' % index, 'width': width, 'height': height})
+	if icon_set == 'strips':
+		for index in range(4):
+			images.append({'name': 'strip%d' % index, 'src': 'icons/strip%d.png' % index, 'width': 8, 'height': rng.randrange(16, 64), 'mode': 'repeat-x'})
+	for image in images:
+		for ratio, suffix in sizes:
+			create_icon(to_localfile(suffix.join(os.path.splitext(image['src']))), image['width'] * ratio, image['height'] * ratio, rng)
+		# dimensions are read by compiler
+		del image['width']
+		del image['height']
+	return {
+		'name': 'benchmark',
+		'output': 'sprites/benchmark.png',
+		'scss_output': 'sprites/_benchmark.scss',
+		'extra_sizes': sizes[1:],
+		'images': images,
+	}
+
+
+def get_fill_ratio(config):
+	used = 0
+	for image in config['images']:
+		if image.get('mode') == 'repeat-x':
+			used += config['width'] * image['height']
+		else:
+			used += image['width'] * image['height']
+	return used / (config['width'] * config['height'])
+
+
+def pack(blocks):
+	width, height = Packer.find_size(blocks)
+	Packer(width, height).fit(blocks)
+
+
+def get_peak_rss():
+	# kilobytes on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_scenario(icon_set, count):
+	static_dir = tempfile.mkdtemp()
+	try:
+		with override_settings(STATICFILES_DIRS=[static_dir], ASSETS_MANAGER_IMAGE_CACHE=False):
+			sprites = generate_icon_set(icon_set, count)
+			compiler = SpriteCompiler(force=True, images=ImageMetadataCache())
+			sources = compiler.get_sources(sprites)
+			configs = []
+			config_time = measure_time(lambda: configs.extend(compiler.get_sprite_configs(sprites, sources)))
+
+			pack_time = measure_time(pack, deepcopy(configs[0]['images']))
+
+			rss_before = get_peak_rss()
+			compose_time = sum(measure_time(generate_sprite, config) for config in configs)
+			peak_rss = get_peak_rss()
+			return {
+				'images': len(sprites['images']),
+				'ratios': len(configs),
+				'width': configs[0]['width'],
+				'height': configs[0]['height'],
+				'config_ms': config_time / 1e6,
+				'pack_ms': pack_time / 1e6,
+				'compose_ms': compose_time / 1e6,
+				'fill_ratio': get_fill_ratio(configs[0]),
+				'png_bytes': sum(os.path.getsize(to_localfile(config['output'])) for config in configs),
+				'peak_rss_kb': peak_rss,
+				'compose_rss_kb': peak_rss - rss_before,
+			}
+	finally:
+		shutil.rmtree(static_dir)
+
+
+def run(quick=False):
+	results = {}
+	context = multiprocessing.get_context('spawn')
+	for icon_set in ICON_SETS:
+		for count in QUICK_COUNTS if quick else COUNTS:
+			# fresh process for every scenario, peak RSS is not shared
+			with ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=init_worker) as executor:
+				results['%s/%d' % (icon_set, count)] = executor.submit(run_scenario, icon_set, count).result()
+	return results
+
+
+def format_results(results):
+	lines = ['%-20s %11s %9s %9s %11s %6s %11s %11s' % ('benchmark', 'size', 'pack_ms', 'config_ms', 'compose_ms', 'fill', 'png_B', 'rss_kB')]
+	for key, values in results.items():
+		lines.append('%-20s %11s %9.2f %9.2f %11.2f %6.3f %11d %11d' % (
+			key,
+			'%dx%d' % (values['width'], values['height']),
+			values['pack_ms'],
+			values['config_ms'],
+			values['compose_ms'],
+			values['fill_ratio'],
+			values['png_bytes'],
+			values['peak_rss_kb'],
+		))
+	return '\n'.join(lines)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import random
+from unittest import mock
+
+from django.http import HttpRequest
+from django.test import override_settings
+
+from django_assets_manager.settings import RESOLUTION_CACHE, load_assets
+from django_assets_manager.templatetags.assets_manager import assets, assets_css, assets_js
+
+from . import measure_peak_memory, measure_time, percentile
+
+
+SIZES = (10, 100, 1000, 10000)
+QUICK_SIZES = (10, 100)
+# name, depth, fan-out
+SHAPES = (
+	('flat', 1, 0),
+	('deep', 16, 2),
+	('wide', 4, 8),
+)
+TAGS = {
+	'assets': assets,
+	'assets_css': assets_css,
+	'assets_js': assets_js,
+}
+MODES = ('request', 'no_request', 'emitted')
+METRICS = (('median_us', False), ('peak_bytes', False))
+TEMPLATES = [
+	{
+		'BACKEND': 'django.template.backends.django.DjangoTemplates',
+		'APP_DIRS': True,
+	},
+]
+
+
+def generate_registry(size, depth, fan_out, seed=0):
+	rng = random.Random(seed)
+	levels = [[] for __ in range(min(depth, size))]
+	files = {}
+	for index in range(size):
+		name = 'asset%d' % index
+		level = index % len(levels)
+		depends = []
+		if level:
+			depends = rng.sample(levels[level - 1], min(fan_out, len(levels[level - 1])))
+		levels[level].append(name)
+		files[name] = {
+			'js': 'static://js/%s.js' % name,
+			'css': 'static://css/%s.css' % name,
+			'depends': depends,
+		}
+	return files, tuple(levels[-1][:3])
+
+
+def make_context(mode, tag, asset_list):
+	context = {'request': HttpRequest()} if mode != 'no_request' else {}
+	if mode == 'emitted':
+		tag(context, *asset_list)
+	return context
+
+
+def measure_tag(tag, asset_list, mode, iterations):
+	RESOLUTION_CACHE.clear()
+	cold = measure_time(tag, make_context(mode, tag, asset_list), *asset_list)
+	times = [measure_time(tag, make_context(mode, tag, asset_list), *asset_list) for __ in range(iterations)]
+	retained, peak = measure_peak_memory(tag, make_context(mode, tag, asset_list), *asset_list)
+	return {
+		'cold_us': cold / 1000,
+		'median_us': percentile(times, 0.5) / 1000,
+		'p95_us': percentile(times, 0.95) / 1000,
+		'peak_bytes': peak,
+		'retained_bytes': retained,
+	}
+
+
+def run(quick=False, iterations=200):
+	results = {}
+	for shape, depth, fan_out in SHAPES:
+		for size in QUICK_SIZES if quick else SIZES:
+			files, asset_list = generate_registry(size, depth, fan_out)
+			with override_settings(ASSETS_MANAGER_FILES=files, TEMPLATES=TEMPLATES):
+				load_assets()
+				for use_templates in (False, True):
+					with mock.patch('django_assets_manager.templatetags.assets_manager.USE_TEMPLATES', use_templates):
+						for mode in MODES:
+							for tag_name, tag in TAGS.items():
+								key = '/'.join((shape, str(size), 'templates' if use_templates else 'direct', mode, tag_name))
+								results[key] = measure_tag(tag, asset_list, mode, iterations)
+	return results
+
+
+def format_results(results):
+	lines = ['%-48s %10s %10s %10s %10s' % ('benchmark', 'median_us', 'p95_us', 'cold_us', 'peak_B')]
+	for key, values in results.items():
+		lines.append('%-48s %10.2f %10.2f %10.2f %10d' % (key, values['median_us'], values['p95_us'], values['cold_us'], values['peak_bytes']))
+	return '\n'.join(lines)
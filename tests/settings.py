@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from pathlib import Path
 
+from django_jinja.builtins import DEFAULT_EXTENSIONS
+
 BASE_DIR = Path(__file__).parent
 
 INSTALLED_APPS = ['tests', 'django_assets_manager']
@@ -10,6 +12,7 @@ ROOT_URLCONF = 'tests.urls'
 USE_TZ = False
 STATICFILES_DIRS = [BASE_DIR / 'static']
 STATIC_URL = '/static/'
+ASSETS_MANAGER_IMAGE_CACHE = False
 
 DATABASES = {
 	'default': {
@@ -31,6 +34,7 @@ TEMPLATES = [
 		'APP_DIRS': False,
 		'OPTIONS': {
 			"match_extension": None,
+			"extensions": DEFAULT_EXTENSIONS + ['django_assets_manager.jinja.AssetsExtension'],
 		}
 	},
 	{
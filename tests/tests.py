@@ -1,21 +1,36 @@
 # -*- coding: utf-8 -*-
+import json
 import os
+import random
 import shutil
+import threading
+from copy import deepcopy
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
 from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+from urllib.error import HTTPError, URLError
 
-import httpretty
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from django.core.management import call_command
+from django.core.management import CommandError, call_command
+from django.template import Context as TemplateContext, Template, engines
 from django.template.loader import get_template
-from django.test import TestCase, override_settings
+from django.test import RequestFactory, TestCase, override_settings
 from jinja2.runtime import Context
 
 from PIL import Image
-from django_assets_manager.checks import check_generated
-from django_assets_manager.utils import NoSpaceError, AssetNotFoundError
-from django_assets_manager.templatetags.assets_manager import assets, assets_by_type
+from django_assets_manager.bundles import BundleSource, load_source_map
+from django_assets_manager.checks import check_generated, check_generated_deploy
+from django_assets_manager.middleware import get_preload_links
+from django_assets_manager.panels import AssetsPanel
+from django_assets_manager.scanner import load_index, load_registry_on_startup, plan_bundles, scan_django_template
+from django_assets_manager.signals import stage_finished
+from django_assets_manager.settings import ASSETS, BUNDLES, RESOLUTION_CACHE, TEMPLATE_ASSETS, finder, load_assets, registry_state, reload_assets
+from django_assets_manager.utils import NoSpaceError, AssetNotFoundError, ImageMetadataCache, Packer, SpriteCompiler, StaticIndex, get_image_cache_path, get_sprite_outputs
+from django_assets_manager.templatetags.assets_manager import assets, assets_by_type, assets_js, nested_render, render_nodelist
 
 
 def get_static_path(path: str) -> Path:
@@ -23,12 +38,36 @@ def get_static_path(path: str) -> Path:
 	return Path.joinpath(static_dir, path)
 
 
+def get_umask() -> int:
+	umask = os.umask(0)
+	os.umask(umask)
+	return umask
+
+
 def clear_cached_static_files():
 	generated_dir = get_static_path('CACHE')
 	if generated_dir.exists():
 		shutil.rmtree(generated_dir)
 
 
+class StageRecorder(object):
+	def __init__(self):
+		self.stages = []
+
+	def __call__(self, stage, duration, info, **kwargs):
+		self.stages.append((stage, dict(info)))
+
+	def __enter__(self):
+		stage_finished.connect(self)
+		return self
+
+	def __exit__(self, *args):
+		stage_finished.disconnect(self)
+
+	def get(self, stage):
+		return [info for name, info in self.stages if name == stage]
+
+
 class TemplateContextMixin(object):
 	def ctx(self):
 		return {}
@@ -113,6 +152,141 @@ class TestAssets(TemplateContextMixin, TestCase):
 	def test_dependencies(self):
 		self.assertEqual('<script src="/static/1.js"></script><script src="/static/2.js"></script>', assets(self.ctx(), 'app'))
 
+	@override_settings(
+		ASSETS_MANAGER_FILES = {
+			'base': {
+				'js': ['static://base.js'],
+			},
+			'dep1': {
+				'js': ['static://1.js'],
+				'depends': ['base'],
+			},
+			'dep2': {
+				'js': ['static://2.js'],
+				'depends': ['base', 'dep1'],
+			},
+			'app': {
+				'js': ['static://app.js'],
+				'depends': ['dep2', 'dep1'],
+			},
+		},
+	)
+	def test_dependencies_already_emitted(self):
+		ctx = self.ctx()
+		self.assertEqual('<script src="/static/base.js"></script><script src="/static/1.js"></script>', assets(ctx, 'dep1'))
+		self.assertEqual('<script src="/static/2.js"></script><script src="/static/app.js"></script>', assets(ctx, 'app'))
+		self.assertEqual('<script src="/static/base.js"></script><script src="/static/1.js"></script><script src="/static/2.js"></script><script src="/static/app.js"></script>', assets(self.ctx(), 'app'))
+
+	@override_settings(
+		ASSETS_MANAGER_FILES = {
+			'app': {
+				'js': 'static://js/app.js',
+			},
+		},
+	)
+	def test_nested_render(self):
+		ctx = self.ctx()
+		with nested_render():
+			self.assertEqual('<script src="/static/js/app.js"></script>', assets(ctx, 'app'))
+			self.assertEqual('', assets(ctx, 'app'))
+		self.assertEqual('<script src="/static/js/app.js"></script>', assets(ctx, 'app'))
+		self.assertEqual('', assets(ctx, 'app'))
+
+		tpl = Template('{% assets "app" %}')
+		ctx = TemplateContext({})
+		self.assertEqual('<script src="/static/js/app.js"></script>', render_nodelist(tpl.nodelist, ctx))
+		self.assertEqual('<script src="/static/js/app.js"></script>', tpl.render(ctx))
+		self.assertEqual('', tpl.render(ctx))
+
+	@override_settings(
+		ASSETS_MANAGER_FILES = {
+			'app': {
+				'js': 'static://js/app.js',
+			},
+		},
+	)
+	def test_project_render_nodelist(self):
+		# render_nodelist function of project is detected by name only when enabled
+		def render_nodelist(nodelist, context):
+			return nodelist.render(context)
+		tpl = Template('{% assets "app" %}')
+		with mock.patch('django_assets_manager.templatetags.assets_manager.DETECT_RENDER_NODELIST', True):
+			ctx = TemplateContext({})
+			self.assertEqual('<script src="/static/js/app.js"></script>', render_nodelist(tpl.nodelist, ctx))
+			self.assertEqual('<script src="/static/js/app.js"></script>', tpl.render(ctx))
+		ctx = TemplateContext({})
+		self.assertEqual('<script src="/static/js/app.js"></script>', render_nodelist(tpl.nodelist, ctx))
+		self.assertEqual('', tpl.render(ctx))
+
+	@override_settings(
+		ASSETS_MANAGER_FILES = {
+			'dep': {
+				'js': ['static://1.js'],
+				'css': ['static://1.css'],
+			},
+			'app': {
+				'css': ['static://2.css'],
+				'depends': ['dep'],
+			},
+		},
+	)
+	def test_request_emitted_assets(self):
+		request = RequestFactory().get('/')
+		ctx = {'request': request}
+		self.assertEqual('<script src="/static/1.js"></script>', assets_by_type(ctx, 'js', 'app'))
+		self.assertEqual('<link rel="stylesheet" href="/static/1.css" />', assets_by_type(ctx, 'css', 'dep'))
+		self.assertEqual('<link rel="stylesheet" href="/static/2.css" />', assets(ctx, 'app', 'dep'))
+		self.assertEqual('', assets(ctx, 'app'))
+		self.assertIsInstance(request.assets_emitted_js, int)
+
+	def test_incremental_reload(self):
+		files = {
+			'dep': {'js': 'static://1.js'},
+			'app': {'js': 'static://2.js', 'depends': ['dep']},
+		}
+		with override_settings(ASSETS_MANAGER_FILES=files):
+			dep, app = load_assets()['dep'], load_assets()['app']
+			files = deepcopy(files)
+			files['app']['js'] = 'static://3.js'
+			files['new'] = {'js': 'static://4.js'}
+			with override_settings(ASSETS_MANAGER_FILES=files):
+				self.assertEqual(['dep', 'app', 'new'], list(load_assets()))
+				self.assertIs(dep, ASSETS['dep'])
+				self.assertIsNot(app, ASSETS['app'])
+				self.assertEqual('<script src="/static/1.js"></script><script src="/static/3.js"></script>', assets(self.ctx(), 'app'))
+			self.assertEqual(['dep', 'app'], list(load_assets()))
+			self.assertIs(dep, ASSETS['dep'])
+			self.assertEqual('<script src="/static/1.js"></script><script src="/static/2.js"></script>', assets(self.ctx(), 'app'))
+
+	def test_resolution_cache_invalidation(self):
+		with override_settings(ASSETS_MANAGER_FILES={'app': {'js': 'static://1.js'}}):
+			self.assertEqual('<script src="/static/1.js"></script>', assets(self.ctx(), 'app'))
+			self.assertIn(('js', ('app',)), RESOLUTION_CACHE)
+		self.assertNotIn(('js', ('app',)), RESOLUTION_CACHE)
+		with override_settings(ASSETS_MANAGER_FILES={'app': {'js': 'static://2.js'}}):
+			self.assertEqual('<script src="/static/2.js"></script>', assets(self.ctx(), 'app'))
+
+	def test_versioned_urls(self):
+		path = get_static_path('CACHE/versioned/app.js')
+		path.parent.mkdir(parents=True, exist_ok=True)
+		path.write_text('app();\n')
+		self.addCleanup(clear_cached_static_files)
+		files = {'app': {'js': ['static://CACHE/versioned/app.js', 'static://missing.js']}}
+		with override_settings(ASSETS_MANAGER_FILES=files, ASSETS_MANAGER_VERSIONED_URLS=True):
+			self.assertEqual('<script src="/static/CACHE/versioned/app.js?v=2592fc76f918"></script><script src="/static/missing.js"></script>', assets(self.ctx(), 'app'))
+			# file content is hashed only when registry is built
+			path.write_text('changed();\n')
+			self.assertIn('?v=2592fc76f918', assets(self.ctx(), 'app'))
+
+			static_root = get_static_path('CACHE/root')
+			static_root.mkdir()
+			static_root.joinpath('staticfiles.json').write_text(json.dumps({'version': '1.1', 'paths': {'CACHE/versioned/app.js': 'CACHE/versioned/app.0123456789ab.js'}}))
+			storages = {'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.ManifestStaticFilesStorage'}}
+			with override_settings(STORAGES=storages, STATIC_ROOT=str(static_root)):
+				self.assertEqual('<script src="/static/CACHE/versioned/app.0123456789ab.js"></script><script src="/static/missing.js"></script>', assets(self.ctx(), 'app'))
+		with override_settings(ASSETS_MANAGER_FILES=files):
+			self.assertEqual('<script src="/static/CACHE/versioned/app.js"></script><script src="/static/missing.js"></script>', assets(self.ctx(), 'app'))
+
 	@override_settings(
 		ASSETS_MANAGER_FILES = {
 			'app': {
@@ -124,6 +298,100 @@ class TestAssets(TemplateContextMixin, TestCase):
 		self.assertEqual('Custom: custom.script', assets_by_type(self.ctx(), 'custom', 'app').strip())
 
 
+@override_settings(
+	ASSETS_MANAGER_FILES = {
+		'dep': {
+			'js': 'static://dep.js',
+			'css': 'static://dep.css',
+		},
+		'app': {
+			'js': 'static://app.js',
+			'depends': ['dep'],
+		},
+	},
+)
+class TestJinjaExtension(TestCase):
+	def test_compiled_assets(self):
+		engine = engines['jinja']
+		extension = engine.env.extensions['django_assets_manager.jinja.AssetsExtension']
+		tpl = engine.from_string('{% assets_css "dep" %}|{{ assets_js("dep") }}|{% assets "app", "dep" %}|{% assets_js "app" %}')
+		self.assertIn((('css', 'js'), ('app', 'dep')), extension.compiled)
+		expected = '<link rel="stylesheet" href="/static/dep.css" />|<script src="/static/dep.js"></script>|<script src="/static/app.js"></script>|'
+		self.assertEqual(expected, tpl.render())
+		self.assertEqual(expected, tpl.render(request=RequestFactory().get('/')))
+		extension.compiled.clear()
+		self.assertEqual(expected, tpl.render())
+
+		files = deepcopy(settings.ASSETS_MANAGER_FILES)
+		files['app']['js'] = 'static://changed.js'
+		with override_settings(ASSETS_MANAGER_FILES=files):
+			self.assertIn('changed.js', tpl.render())
+
+	def test_dynamic_assets(self):
+		tpl = engines['jinja'].from_string('{% assets_js name %}{% assets_js "dep" %}')
+		self.assertEqual('<script src="/static/dep.js"></script><script src="/static/app.js"></script>', tpl.render({'name': 'app'}))
+
+	def test_unregistered_asset(self):
+		tpl = engines['jinja'].from_string('{% assets "missing" %}')
+		with self.assertRaises(ImproperlyConfigured):
+			tpl.render()
+
+
+@override_settings(
+	ASSETS_MANAGER_FILES = {
+		'dep': {
+			'js': 'static://dep.js',
+		},
+		'app': {
+			'js': 'static://app.js',
+			'css': 'static://app.css',
+			'depends': ['dep'],
+		},
+	},
+)
+class TestInstrumentation(TemplateContextMixin, TestCase):
+	def setUp(self):
+		reload_assets()
+
+	def test_tag_stages(self):
+		ctx = self.ctx()
+		with StageRecorder() as recorder:
+			assets(ctx, 'app')
+			assets(ctx, 'app')
+		self.assertEqual(['resolve', 'render', 'assets', 'resolve', 'render', 'assets', 'assets', 'assets'], [stage for stage, __ in recorder.stages])
+		calls = recorder.get('assets')
+		self.assertEqual({'asset_type': 'js', 'asset_list': ('app',), 'cache_hit': False, 'emitted': ['dep', 'app']}, calls[1])
+		self.assertEqual({'asset_type': 'js', 'asset_list': ('app',), 'cache_hit': True, 'emitted': []}, calls[3])
+
+		tpl = engines['jinja'].from_string('{% assets_js "app" %}{% assets_css name %}')
+		with StageRecorder() as recorder:
+			self.assertEqual('<script src="/static/dep.js"></script><script src="/static/app.js"></script><link rel="stylesheet" href="/static/app.css" />', tpl.render({'name': 'app'}))
+		self.assertEqual([['dep', 'app'], ['dep', 'app']], [info['emitted'] for info in recorder.get('assets')])
+
+	def test_debug_toolbar_panel(self):
+		panel = AssetsPanel(SimpleNamespace(stats={}), None)
+		self.assertEqual('', panel.nav_subtitle)
+		panel.enable_instrumentation()
+		try:
+			ctx = self.ctx()
+			assets_js(ctx, 'app')
+			assets_js(ctx, 'app')
+			thread = threading.Thread(target=assets_js, args=({}, 'app'))
+			thread.start()
+			thread.join()
+		finally:
+			panel.disable_instrumentation()
+		panel.generate_stats(None, None)
+		stats = panel.get_stats()
+		self.assertEqual(['app', 'app'], [call['asset_list'] for call in stats['calls']])
+		self.assertEqual('dep, app', stats['calls'][0]['emitted'])
+		self.assertEqual(1, stats['cache_hits'])
+		self.assertEqual(['render', 'resolve'], [stage['stage'] for stage in stats['stages']])
+		self.assertTrue(panel.nav_subtitle.startswith('2 calls in '))
+		with override_settings(TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates', 'APP_DIRS': True}]):
+			self.assertIn('<td>dep, app</td>', panel.content)
+
+
 class ImagesTestMixin(object):
 	def create_image(self, path: str, width: int, height: int):
 		image_path = get_static_path(path)
@@ -153,7 +421,7 @@ class TestChecks(ImagesTestMixin, TestCase):
 				'images': (
 					{
 						'name': 'img',
-						'src': 'img.png',
+						'src': 'CACHE/img.png',
 					},
 				),
 			},
@@ -161,8 +429,8 @@ class TestChecks(ImagesTestMixin, TestCase):
 	)
 	def test_recompilation_needed(self):
 		# Create test images
-		self.create_image('img.png', width=1, height=1)
-		self.create_image('img@2x.png', width=2, height=2)
+		self.create_image('CACHE/img.png', width=1, height=1)
+		self.create_image('CACHE/img@2x.png', width=2, height=2)
 
 		# not generated
 		errors = check_generated()
@@ -173,14 +441,69 @@ class TestChecks(ImagesTestMixin, TestCase):
 		errors = check_generated()
 		self.assertEqual(0, len(errors))
 
-		# now pretend, that generated file is order
+		# older generated file is not an error, only content of sources matters
 		older_time = int(datetime.now().timestamp()) - 1000000000
 		generated_file = get_static_path('CACHE/sprites.png')
 		os.utime(generated_file, (older_time, older_time))
+		with mock.patch.object(StaticIndex, 'build', side_effect=AssertionError):
+			errors = check_generated()
+		self.assertEqual(0, len(errors))
+
+		# touched source without change is checked using slow path only once, nothing is written
+		manifest = get_static_path('CACHE/.sprites.png.json').read_text()
+		self.assertEqual({'CACHE/img.png', 'CACHE/img@2x.png'}, set(json.loads(manifest)['sources']))
+		os.utime(get_static_path('CACHE/img@2x.png'), (older_time, older_time))
+		with mock.patch('django_assets_manager.utils.write_if_changed', side_effect=AssertionError), mock.patch.object(ImageMetadataCache, 'save', side_effect=AssertionError):
+			self.assertEqual(0, len(check_generated()))
+			with mock.patch.object(SpriteCompiler, 'get_fingerprint', side_effect=AssertionError):
+				self.assertEqual(0, len(check_generated()))
+			self.assertEqual(0, len(check_generated_deploy()))
+		self.assertEqual(manifest, get_static_path('CACHE/.sprites.png.json').read_text())
+
+		# compilation refreshes stats of touched sources, outputs are kept
+		generated_mtime = generated_file.stat().st_mtime_ns
+		call_command('compilesprites')
+		self.assertNotEqual(manifest, get_static_path('CACHE/.sprites.png.json').read_text())
+		self.assertEqual(generated_mtime, generated_file.stat().st_mtime_ns)
+		with mock.patch.dict('django_assets_manager.utils.CHECKED_SOURCE_STATS', clear=True), mock.patch.object(SpriteCompiler, 'get_fingerprint', side_effect=AssertionError):
+			self.assertEqual(0, len(check_generated()))
 
-		# check again
+		# moved source or manifest without filenames is resolved using static index
+		manifest_path = get_static_path('CACHE/.sprites.png.json')
+		data = json.loads(manifest_path.read_text())
+		data['sources']['CACHE/img.png'][2] = '/nonexistent'
+		del data['sources']['CACHE/img@2x.png'][2]
+		manifest_path.write_text(json.dumps(data))
+		with mock.patch.dict('django_assets_manager.utils.CHECKED_SOURCE_STATS', clear=True), mock.patch.object(SpriteCompiler, 'get_fingerprint', side_effect=AssertionError):
+			self.assertEqual(0, len(check_generated()))
+
+		# changed source
+		self.create_image('CACHE/img@2x.png', width=2, height=1)
 		errors = check_generated()
 		self.assertEqual(1, len(errors))
+		self.assertEqual(1, len(check_generated_deploy()))
+
+		with override_settings(ASSETS_MANAGER_SPRITES_CHECK='deploy'):
+			self.assertEqual(0, len(check_generated()))
+			self.assertEqual(1, len(check_generated_deploy()))
+
+		# removed output
+		call_command('compilesprites')
+		self.assertEqual(0, len(check_generated()))
+		generated_file.unlink()
+		self.assertEqual(1, len(check_generated()))
+
+		# changed configuration
+		call_command('compilesprites')
+		sprites = deepcopy(settings.ASSETS_MANAGER_SPRITES)
+		sprites[0]['width'] = 320
+		with override_settings(ASSETS_MANAGER_SPRITES=sprites):
+			self.assertEqual(1, len(check_generated()))
+
+		# removed source
+		get_static_path('CACHE/img@2x.png').unlink()
+		with self.assertRaises(AssetNotFoundError):
+			check_generated()
 
 	@override_settings(
 		ASSETS_MANAGER_SPRITES = [
@@ -205,13 +528,46 @@ class TestChecks(ImagesTestMixin, TestCase):
 			check_generated()
 
 
+class CdnRequestHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		self.server.requests.append(self.path)
+		responses = self.server.responses.get(self.path, [(404, b'')])
+		status, body = responses.pop(0) if len(responses) > 1 else responses[0]
+		if status == 'truncated':
+			self.send_response(200)
+			self.send_header('Content-Length', str(len(body) + 10))
+			self.end_headers()
+			self.wfile.write(body)
+			return
+		self.send_response(status)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args): #pylint: disable=redefined-builtin
+		pass
+
+
 class TestCdnFinder(TemplateContextMixin, TestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.server = ThreadingHTTPServer(('127.0.0.1', 0), CdnRequestHandler)
+		cls.server_url = '//127.0.0.1:%d' % cls.server.server_address[1]
+		cls.server_thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+		cls.server_thread.start()
+
 	def setUp(self):
 		clear_cached_static_files()
+		self.server.requests = []
+		self.server.responses = {}
 
 	@classmethod
 	def tearDownClass(cls):
+		cls.server.shutdown()
+		cls.server.server_close()
 		clear_cached_static_files()
+		super().tearDownClass()
 
 	@override_settings(
 		ASSETS_MANAGER_FILES = {
@@ -223,41 +579,429 @@ class TestCdnFinder(TemplateContextMixin, TestCase):
 	def test_get_external_files(self):
 		self.assertEqual('<script src="//external.com/script.js"></script>', assets(self.ctx(), 'app'))
 
-	@httpretty.activate
 	def test_cached_external_file(self):
-		httpretty.register_uri(httpretty.GET, "http://external.com/script.js", body="")
-		httpretty.register_uri(httpretty.GET, "http://external.com/script2.js", body="")
+		self.server.responses['/script.js'] = [(200, b'script')]
+		self.server.responses['/script2.js'] = [(200, b'script2')]
+		url = self.server_url
 		with override_settings(
 			ASSETS_MANAGER_FILES = {
 				'app': {
-					'js': 'http://external.com/script.js',
+					'js': f'http:{url}/script.js',
 					'cache': {
 						'paths': {
-							'http://external.com/script.js': 'script.js',
+							f'http:{url}/script.js': 'script.js',
 						}
 					},
 				},
 			},
 		):
+			# nothing is downloaded on settings load
+			self.assertEqual(f'<script src="http:{url}/script.js"></script>', assets(self.ctx(), 'app'))
+			self.assertEqual([], self.server.requests)
+			call_command('fetchassets', verbosity=0)
 			self.assertEqual('<script src="/static/CACHE/app/script.js"></script>', assets(self.ctx(), 'app'))
 		# same request without http prefix
 		with override_settings(
 			ASSETS_MANAGER_FILES = {
 				'app': {
-					'js': ['http://external.com/script.js', '//external.com/script2.js'],
+					'js': [f'http:{url}/script.js', f'{url}/script2.js'],
 					'cache': {
 						'paths': {
-							'http://external.com/script.js': 'script.js',
-							'//external.com/script2.js': 'script2.js',
+							f'http:{url}/script.js': 'script.js',
+							f'{url}/script2.js': 'script2.js',
 						}
 					},
 				},
 			},
 		):
+			call_command('fetchassets', stdout=StringIO())
 			self.assertEqual('<script src="/static/CACHE/app/script.js"></script><script src="/static/CACHE/app/script2.js"></script>', assets(self.ctx(), 'app'))
+		self.assertEqual(b'script2', get_static_path('CACHE/app/script2.js').read_bytes())
+		self.assertEqual(['/script.js', '/script2.js'], self.server.requests)
+
+	def test_concurrent_downloads(self):
+		paths = {}
+		for i in range(20):
+			self.server.responses[f'/{i}.js'] = [(200, str(i).encode('utf-8') * 100000)]
+			paths[f'{self.server_url}/{i}.js'] = f'{i}.js'
+		with override_settings(ASSETS_MANAGER_FILES={'app': {'js': list(paths), 'cache': {'paths': paths}}, 'local': {'js': 'static://1.js'}}):
+			self.assertEqual(sorted(paths.values()), sorted(dest for dest, __ in finder.list([])))
+			self.assertEqual(20, len(self.server.requests))
+			self.assertEqual(sorted(paths.values()), sorted(dest for dest, __ in finder.list([])))
+			self.assertEqual(20, len(self.server.requests))
+		for i in range(20):
+			self.assertEqual(str(i).encode('utf-8') * 100000, get_static_path(f'CACHE/app/{i}.js').read_bytes())
+
+	def test_download_retry(self):
+		self.server.responses['/retry.js'] = [(500, b''), (503, b''), (200, b'retry')]
+		dest_path = get_static_path('CACHE/app/retry.js')
+		with mock.patch('django_assets_manager.settings.CDN_RETRY_DELAY', 0), StageRecorder() as recorder:
+			finder.download(f'{self.server_url}/retry.js', dest_path)
+		self.assertEqual([{'url': f'{self.server_url}/retry.js', 'attempts': 3}], recorder.get('download'))
+		self.assertEqual(b'retry', dest_path.read_bytes())
+		self.assertEqual(0o666 & ~get_umask(), dest_path.stat().st_mode & 0o777)
+		self.assertEqual(3, len(self.server.requests))
+
+		self.server.responses['/error.js'] = [(500, b'')]
+		with mock.patch('django_assets_manager.settings.CDN_RETRY_DELAY', 0):
+			with self.assertRaises(HTTPError):
+				finder.download(f'{self.server_url}/error.js', get_static_path('CACHE/app/error.js'))
+		self.assertEqual(6, len(self.server.requests))
+
+	def test_download_not_found(self):
+		with self.assertRaises(HTTPError):
+			finder.download(f'{self.server_url}/missing.js', get_static_path('CACHE/app/missing.js'))
+		self.assertEqual(1, len(self.server.requests))
+		self.assertEqual([], list(get_static_path('CACHE/app').iterdir()))
+
+	def test_truncated_download(self):
+		self.server.responses['/truncated.js'] = [('truncated', b'truncated')]
+		dest_path = get_static_path('CACHE/app/truncated.js')
+		with mock.patch('django_assets_manager.settings.CDN_RETRY_DELAY', 0):
+			with self.assertRaises(URLError):
+				finder.download(f'{self.server_url}/truncated.js', dest_path)
+		self.assertEqual([], list(get_static_path('CACHE/app').iterdir()))
+
+
+class TestBundles(TemplateContextMixin, TestCase):
+	def setUp(self):
+		clear_cached_static_files()
+		files = {
+			'CACHE/src/base.js': 'var base = 1\n//# sourceMappingURL=base.js.map',
+			'CACHE/src/base.js.map': json.dumps({'version': 3, 'sections': []}),
+			'CACHE/src/base.css.map': json.dumps({'version': 3, 'sources': ['base.scss'], 'names': [], 'mappings': 'AAAA'}),
+			'CACHE/src/base.css': '.a { background: url("../img/a.png"); }\n.b { background: url(data:image/png;base64,AA==); }\n/*# sourceMappingURL=base.css.map */\n',
+			'CACHE/src/app.js': 'var app = 2;\nvar x = 3;\n//# sourceMappingURL=app.js.map\n',
+			'CACHE/src/app.js.map': json.dumps({'version': 3, 'sourceRoot': 'orig', 'sources': ['app.ts'], 'names': [], 'mappings': 'AAAA;AACA'}),
+			'CACHE/src/other.js': 'var other = 4;\n',
+			'CACHE/src/invalid.js': 'var invalid = 5;\n//# sourceMappingURL=invalid.js.map\n',
+			'CACHE/src/invalid.js.map': 'invalid',
+			'CACHE/cdn/cdn.js': 'var cdn = 6;\n//# sourceMappingURL=cdn.js.map\n',
+		}
+		for path, content in files.items():
+			path = get_static_path(path)
+			path.parent.mkdir(parents=True, exist_ok=True)
+			path.write_text(content)
+
+	@classmethod
+	def tearDownClass(cls):
+		clear_cached_static_files()
+		super().tearDownClass()
+
+	def get_files(self):
+		return {
+			'base': {
+				'js': 'static://CACHE/src/base.js',
+				'css': 'static://CACHE/src/base.css',
+			},
+			'cdn': {
+				'js': '//cdn.tld/cdn.js',
+				'cache': {'paths': {'//cdn.tld/cdn.js': 'cdn.js'}},
+			},
+			'app': {
+				'js': ['static://CACHE/src/app.js', 'static://CACHE/src/invalid.js'],
+				'depends': ['base', 'cdn'],
+			},
+			'other': {
+				'js': 'static://CACHE/src/other.js',
+			},
+			'external': {
+				'js': '//cdn.tld/external.js',
+			},
+			'missing': {
+				'js': 'static://CACHE/src/missing.js',
+			},
+		}
+
+	def test_bundles(self):
+		with override_settings(ASSETS_MANAGER_FILES=self.get_files(), ASSETS_MANAGER_BUNDLES={'main': ['app'], 'base': 'base'}):
+			call_command('bundleassets', verbosity=0)
+			call_command('bundleassets', stdout=StringIO())
+			manifest = json.loads(get_static_path('CACHE/bundles/.manifest.json').read_text())['bundles']
+			self.assertEqual(['base', 'cdn', 'app'], manifest['main']['assets'])
+			self.assertEqual(['base'], manifest['base']['assets'])
+			main_js = manifest['main']['js']
+			content = get_static_path(main_js).read_text()
+			self.assertEqual('var base = 1\n;\nvar cdn = 6;\n;\nvar app = 2;\nvar x = 3;\n;\nvar invalid = 5;\n;\n//# sourceMappingURL=' + os.path.basename(main_js) + '.map\n', content)
+			source_map = json.loads(get_static_path(main_js + '.map').read_text())
+			self.assertEqual([0, 2, 4, 7], [section['offset']['line'] for section in source_map['sections']])
+			self.assertEqual(['/static/CACHE/src/orig/app.ts'], source_map['sections'][2]['map']['sources'])
+			self.assertEqual(['//cdn.tld/cdn.js'], source_map['sections'][1]['map']['sources'])
+			self.assertEqual('AAAA', source_map['sections'][3]['map']['mappings'])
+			self.assertIsNone(load_source_map(BundleSource('/static/CACHE/src/other.js', get_static_path('CACHE/src/other.js')), 'missing.js.map'))
+			css = get_static_path(manifest['main']['css']).read_text()
+			self.assertIn('url("/static/CACHE/img/a.png")', css)
+			self.assertIn('url(data:image/png;base64,AA==)', css)
+			self.assertNotIn('sourceMappingURL=base.css.map', css)
+			source_map = json.loads(get_static_path(manifest['main']['css'] + '.map').read_text())
+			self.assertEqual(['/static/CACHE/src/base.scss'], source_map['sections'][0]['map']['sources'])
+
+			ctx = self.ctx()
+			self.assertEqual(f'<link rel="stylesheet" href="/static/{manifest["main"]["css"]}" /><script src="/static/{main_js}"></script>', assets(ctx, 'app'))
+			self.assertEqual('', assets(ctx, 'base'))
+			self.assertEqual('<script src="/static/CACHE/src/other.js"></script>', assets(ctx, 'other'))
+
+			# bundle with exactly requested assets is used, main bundle can't be used because base is already emitted
+			ctx = self.ctx()
+			self.assertEqual(f'<script src="/static/{manifest["base"]["js"]}"></script>', assets_by_type(ctx, 'js', 'base'))
+			self.assertEqual('<script src="/static/CACHE/cdn/cdn.js"></script><script src="/static/CACHE/src/app.js"></script><script src="/static/CACHE/src/invalid.js"></script>', assets_by_type(ctx, 'js', 'app'))
+
+			self.assertEqual(f'</static/{manifest["main"]["css"]}>; rel=preload; as=style, </static/{manifest["main"]["js"]}>; rel=preload; as=script', get_preload_links(('app',)))
+
+		# changed configuration invalidates bundle
+		files = self.get_files()
+		files['app']['js'] = 'static://CACHE/src/other.js'
+		with override_settings(ASSETS_MANAGER_FILES=files):
+			self.assertTrue(assets_by_type(self.ctx(), 'js', 'app').endswith('<script src="/static/CACHE/src/other.js"></script>'))
+			self.assertEqual(f'<script src="/static/{manifest["base"]["js"]}"></script>', assets_by_type(self.ctx(), 'js', 'base'))
+
+	def test_outdated_bundles(self):
+		with override_settings(ASSETS_MANAGER_FILES=self.get_files(), ASSETS_MANAGER_BUNDLES={'main': ['app'], 'base': 'base'}):
+			call_command('bundleassets', verbosity=0)
+			manifest_path = get_static_path('CACHE/bundles/.manifest.json')
+			manifest = json.loads(manifest_path.read_text())['bundles']
+			self.assertEqual(['CACHE/cdn/cdn.js', 'CACHE/src/app.js', 'CACHE/src/base.css', 'CACHE/src/base.js', 'CACHE/src/invalid.js'], sorted(manifest['main']['sources']))
+			load_assets()
+			self.assertEqual(2, len(BUNDLES))
+
+			# sources with unchanged stats are not hashed
+			with mock.patch('django_assets_manager.settings.get_file_hash', side_effect=AssertionError):
+				reload_assets(full=True)
+				load_assets()
+			self.assertEqual(2, len(BUNDLES))
+
+			# touched source without change
+			older_time = int(datetime.now().timestamp()) - 1000000000
+			os.utime(get_static_path('CACHE/src/app.js'), (older_time, older_time))
+			reload_assets(full=True)
+			load_assets()
+			self.assertEqual(2, len(BUNDLES))
+
+			# changed content of source
+			get_static_path('CACHE/src/app.js').write_text('var app = 7;\n')
+			reload_assets(full=True)
+			load_assets()
+			self.assertEqual([['base']], [bundle['assets'] for bundle in BUNDLES])
+
+			# removed source
+			get_static_path('CACHE/src/base.css').unlink()
+			reload_assets(full=True)
+			load_assets()
+			self.assertEqual([], BUNDLES)
+
+			# manifest without sources
+			data = json.loads(manifest_path.read_text())
+			for bundle in data['bundles'].values():
+				del bundle['sources']
+			manifest_path.write_text(json.dumps(data))
+			get_static_path('CACHE/src/base.css').write_text('.a {}\n')
+			reload_assets(full=True)
+			load_assets()
+			self.assertEqual([], BUNDLES)
+
+	def test_exact_bundle(self):
+		with override_settings(ASSETS_MANAGER_FILES=self.get_files(), ASSETS_MANAGER_BUNDLES={'main': ['app']}):
+			call_command('bundleassets', verbosity=0)
+			manifest = json.loads(get_static_path('CACHE/bundles/.manifest.json').read_text())['bundles']
+			# bundle containing other assets is not used
+			ctx = self.ctx()
+			self.assertEqual('<script src="/static/CACHE/src/base.js"></script>', assets_by_type(ctx, 'js', 'base'))
+			self.assertEqual('<script src="/static/CACHE/cdn/cdn.js"></script><script src="/static/CACHE/src/app.js"></script><script src="/static/CACHE/src/invalid.js"></script>', assets_by_type(ctx, 'js', 'app'))
+			self.assertEqual(f'<script src="/static/{manifest["main"]["js"]}"></script>', assets_by_type(self.ctx(), 'js', 'app'))
+			self.assertEqual('</static/CACHE/src/base.css>; rel=preload; as=style, </static/CACHE/src/base.js>; rel=preload; as=script', get_preload_links(('base',)))
+
+	def test_bundle_errors(self):
+		with override_settings(ASSETS_MANAGER_FILES=self.get_files()):
+			with self.assertRaises(CommandError):
+				call_command('bundleassets')
+			with override_settings(ASSETS_MANAGER_BUNDLES={'main': ['external']}):
+				with self.assertRaises(ImproperlyConfigured):
+					call_command('bundleassets')
+			with override_settings(ASSETS_MANAGER_BUNDLES={'main': ['missing']}):
+				with self.assertRaises(AssetNotFoundError):
+					call_command('bundleassets')
+			get_static_path('CACHE/cdn/cdn.js').unlink()
+			with override_settings(ASSETS_MANAGER_BUNDLES={'main': ['cdn']}):
+				with self.assertRaises(AssetNotFoundError):
+					call_command('bundleassets')
+
+
+@override_settings(
+	MIDDLEWARE=['django_assets_manager.middleware.PreloadMiddleware'],
+	ASSETS_MANAGER_FILES={
+		'dep': {
+			'js': 'static://js/dep.js',
+			'css': 'static://css/dep.css?a=1&b=2',
+		},
+		'app': {
+			'js': '//cdn.tld/app.js',
+			'depends': ['dep'],
+		},
+	},
+)
+class TestPreload(TestCase):
+	def test_preload_header(self):
+		response = self.client.get('/preload/')
+		self.assertEqual('</static/css/dep.css?a=1&b=2>; rel=preload; as=style, </static/js/dep.js>; rel=preload; as=script, <//cdn.tld/app.js>; rel=preload; as=script', response['Link'])
+		response = self.client.get('/preload/', {'font': '1'})
+		self.assertTrue(response['Link'].startswith('</static/font.woff2>; rel=preload; as=font, </static/css/dep.css'))
+		self.assertNotIn('Link', self.client.get('/no-preload/'))
+
+	def test_unregistered_asset(self):
+		with override_settings(ASSETS_MANAGER_FILES={}):
+			with self.assertRaises(ImproperlyConfigured):
+				self.client.get('/preload/')
+
+
+class TestScanner(TestCase):
+	def setUp(self):
+		clear_cached_static_files()
+		self.addCleanup(clear_cached_static_files)
+		templates = {
+			'django/base.html': '<html>{% assets_css "dep" %}{% block content %}{% endblock %}{% assets_js name %}{% include template_name %}',
+			'django/page.html': '{% extends "base.html" %}{% block content %}{% assets "app" \'dep\' %}{% include "missing.html" %}{% endblock %}',
+			'jinja/page.html': '{% extends "layout.html" %}{% block content %}{% assets_js "other" %}{{ assets_css("app") }}{{ assets(name) }}{% endblock %}',
+			'jinja/page2.html': '{% extends "page.html" %}',
+			'jinja/layout.html': '{% include "base.html" %}{% include template_name %}',
+			'jinja/broken.html': '{% if %}',
+			'static/dep.js': 'dep();',
+			'static/dep.css': '.dep {}',
+			'static/app.js': 'app();',
+			'static/other.js': 'other();',
+		}
+		for path, content in templates.items():
+			path = get_static_path('CACHE/scan/' + path)
+			path.parent.mkdir(parents=True, exist_ok=True)
+			path.write_text(content)
+		for directory in ('django', 'jinja'):
+			get_static_path(f'CACHE/scan/{directory}/image.bin').write_bytes(b'\xff\xfe\x00')
+		get_static_path('CACHE/scan/django/link.html').symlink_to('nonexistent.html')
+
+		self.settings = override_settings(
+			ASSETS_MANAGER_TEMPLATES_INDEX=str(get_static_path('CACHE/templates.json')),
+			ASSETS_MANAGER_FILES={
+				'dep': {'js': 'static://CACHE/scan/static/dep.js', 'css': 'static://CACHE/scan/static/dep.css'},
+				'app': {'js': 'static://CACHE/scan/static/app.js', 'depends': ['dep']},
+				'other': {'js': 'static://CACHE/scan/static/other.js'},
+			},
+			TEMPLATES=[
+				{
+					'BACKEND': 'django_jinja.backend.Jinja2',
+					'DIRS': [get_static_path('CACHE/scan/jinja')],
+					'OPTIONS': {'match_extension': None, 'extensions': settings.TEMPLATES[0]['OPTIONS']['extensions']},
+				},
+				{
+					'BACKEND': 'django.template.backends.django.DjangoTemplates',
+					'DIRS': [get_static_path('CACHE/scan/django')],
+					'APP_DIRS': True,
+				},
+				{
+					'BACKEND': 'django.template.backends.django.DjangoTemplates',
+					'NAME': 'plain',
+				},
+				{
+					'BACKEND': 'django.template.backends.dummy.TemplateStrings',
+					'APP_DIRS': True,
+				},
+			],
+		)
+		self.settings.enable()
+		self.addCleanup(self.settings.disable)
+
+	def test_scan_templates(self):
+		stdout = StringIO()
+		call_command('scanassets', stdout=stdout)
+		self.assertEqual('4 templates using assets', stdout.getvalue().strip())
+		templates = json.loads(get_static_path('CACHE/templates.json').read_text())['templates']
+		self.assertLessEqual({'base.html', 'page.html', 'page2.html', 'layout.html', 'broken.html', 'django/index.html'}, set(templates))
+		self.assertEqual({'calls': [[['css'], ['dep']]], 'depends': [], 'assets': ['dep']}, templates['base.html'])
+		self.assertEqual([[['js'], ['other']], [['css'], ['app']], [['css', 'js'], ['app', 'dep']]], sorted(templates['page.html']['calls'], key=len))
+		self.assertEqual(['missing.html', 'layout.html', 'base.html'], sorted(templates['page.html']['depends'], key=len, reverse=True))
+		self.assertEqual(['other', 'dep', 'app'], templates['page.html']['assets'])
+		self.assertEqual(['other', 'dep', 'app'], templates['page2.html']['assets'])
+		self.assertEqual([], templates['broken.html']['assets'])
+
+		load_assets()
+		self.assertIn(('css', ('app', 'dep')), RESOLUTION_CACHE)
+		self.assertIn(('js', ('other',)), RESOLUTION_CACHE)
+		self.assertEqual(('other', 'dep', 'app'), TEMPLATE_ASSETS['page.html'])
+		with override_settings(MIDDLEWARE=['django_assets_manager.middleware.PreloadMiddleware']):
+			self.assertEqual('</static/CACHE/scan/static/dep.css>; rel=preload; as=style, </static/CACHE/scan/static/other.js>; rel=preload; as=script, </static/CACHE/scan/static/dep.js>; rel=preload; as=script, </static/CACHE/scan/static/app.js>; rel=preload; as=script', self.client.get('/template-preload/')['Link'])
+
+		reload_assets()
+		load_registry_on_startup()
+		self.assertTrue(registry_state['loaded'])
+
+		# assets removed after scan are ignored
+		with override_settings(ASSETS_MANAGER_FILES={'dep': {'js': 'static://CACHE/scan/static/dep.js'}}):
+			load_assets()
+			self.assertEqual({'dep'}, set(TEMPLATE_ASSETS['base.html'] + TEMPLATE_ASSETS['layout.html']))
+			self.assertNotIn('page.html', TEMPLATE_ASSETS)
+
+		self.assertEqual({'page-html': ['other', 'dep', 'app']}, plan_bundles())
+		call_command('bundleassets', '--templates', verbosity=0)
+		self.assertEqual(['page-html'], list(json.loads(get_static_path('CACHE/bundles/.manifest.json').read_text())['bundles']))
+
+	def test_invalid_index(self):
+		index = get_static_path('CACHE/templates.json')
+		index.write_text('invalid')
+		self.assertEqual({}, load_index())
+		index.write_text(json.dumps({'version': 0}))
+		self.assertEqual({}, load_index())
+		with override_settings(ASSETS_MANAGER_TEMPLATES_INDEX=False):
+			call_command('scanassets', verbosity=0)
+			self.assertEqual({}, load_index())
+		self.assertEqual({'version': 0}, json.loads(index.read_text()))
+
+	def test_empty_tag(self):
+		self.assertEqual(([[['css', 'js'], ['app']]], []), scan_django_template('a {% %} b {% assets "app" %}'))
+
+
+class TestStaticIndex(TestCase):
+	def setUp(self):
+		clear_cached_static_files()
+
+	@classmethod
+	def tearDownClass(cls):
+		clear_cached_static_files()
+		super().tearDownClass()
+
+	def test_find(self):
+		for path in ('CACHE/index/a.png', 'CACHE/extra/b.png', 'CACHE/extra/index/a.png', 'CACHE/linked/c.png'):
+			get_static_path(path).parent.mkdir(parents=True, exist_ok=True)
+			get_static_path(path).write_bytes(b'')
+		get_static_path('CACHE/index/linked').symlink_to(get_static_path('CACHE/linked'))
+		static_dirs = [
+			settings.STATICFILES_DIRS[0],
+			('pre', str(get_static_path('CACHE/extra'))),
+			str(get_static_path('CACHE/missing')),
+		]
+		with override_settings(STATICFILES_DIRS=static_dirs, STATICFILES_FINDERS=['django.contrib.staticfiles.finders.FileSystemFinder', 'django.contrib.staticfiles.finders.AppDirectoriesFinder']):
+			index = StaticIndex()
+			self.assertEqual(str(get_static_path('CACHE/index/a.png')), index.find('CACHE/index/a.png'))
+			self.assertEqual(str(get_static_path('CACHE/extra/b.png')), index.find('pre/b.png'))
+			self.assertEqual(str(get_static_path('CACHE/extra/index/a.png')), index.find('pre/index/a.png'))
+			self.assertNotIn('CACHE/index/linked/c.png', index.files)
+			# resolved by finders
+			self.assertTrue(index.find('CACHE/index/linked/c.png').endswith('c.png'))
+			self.assertIsNone(index.find('CACHE/index/missing.png'))
+
+			# files of other finders could shadow following finders
+			with override_settings(STATICFILES_FINDERS=['django_assets_manager.finders.CdnFinder', 'django.contrib.staticfiles.finders.FileSystemFinder']):
+				index = StaticIndex()
+				self.assertEqual(str(get_static_path('CACHE/index/a.png')), index.find('CACHE/index/a.png'))
+				self.assertEqual({}, index.files)
 
 
 class TestCompilesprites(TemplateContextMixin, ImagesTestMixin, TestCase):
+	def setUp(self):
+		clear_cached_static_files()
+
+	@classmethod
+	def tearDownClass(cls):
+		clear_cached_static_files()
+		super().tearDownClass()
+
 	@override_settings(
 		ASSETS_MANAGER_SPRITES = [
 			{
@@ -280,6 +1024,148 @@ class TestCompilesprites(TemplateContextMixin, ImagesTestMixin, TestCase):
 		self.create_image('CACHE/src.png', width=1, height=1)
 		call_command('compilesprites')
 
+	@override_settings(
+		ASSETS_MANAGER_SPRITES = [
+			{
+				'name': 'main',
+				'output': 'CACHE/sprites.png',
+				'scss_output': 'CACHE/sprites.scss',
+				'extra_sizes': [(2, '@2x')],
+				'optimize': True,
+				'quantize': 16,
+				'formats': {'avif': {}, 'webp': {'lossless': True}},
+				'images': (
+					{
+						'name': 'a',
+						'src': 'CACHE/a.png',
+					},
+				),
+			},
+			{
+				'name': 'other',
+				'output': 'CACHE/other.png',
+				'scss_output': 'CACHE/other.scss',
+				'formats': ['webp'],
+				'images': (
+					{
+						'name': 'a',
+						'src': 'CACHE/a.png',
+					},
+				),
+			},
+		],
+	)
+	def test_output_formats(self):
+		self.create_image('CACHE/a.png', width=2, height=2)
+		self.create_image('CACHE/a@2x.png', width=4, height=4)
+		call_command('compilesprites')
+		with Image.open(get_static_path('CACHE/sprites@2x.png')) as image:
+			self.assertEqual('P', image.mode)
+		for path, image_format in (('CACHE/sprites.webp', 'WEBP'), ('CACHE/sprites@2x.avif', 'AVIF'), ('CACHE/other.webp', 'WEBP')):
+			with Image.open(get_static_path(path)) as image:
+				self.assertEqual(image_format, image.format)
+		scss = get_static_path('CACHE/sprites.scss').read_text()
+		self.assertIn('_url-webp: (url(static("CACHE/sprites.webp")) url(static("CACHE/sprites@2x.webp"))),', scss)
+		self.assertIn('_image-set: image-set(url(static("CACHE/sprites.avif")) type("image/avif") 1x, url(static("CACHE/sprites@2x.avif")) type("image/avif") 2x, url(static("CACHE/sprites.webp")) type("image/webp") 1x, url(static("CACHE/sprites@2x.webp")) type("image/webp") 2x, url(static("CACHE/sprites.png")) type("image/png") 1x, url(static("CACHE/sprites@2x.png")) type("image/png") 2x),', scss)
+		self.assertIn('_image-set: image-set(url(static("CACHE/other.webp")) type("image/webp") 1x, url(static("CACHE/other.png")) type("image/png") 1x),', get_static_path('CACHE/other.scss').read_text())
+
+		# missing alternate output is regenerated
+		get_static_path('CACHE/sprites@2x.webp').unlink()
+		self.assertTrue(check_generated())
+		call_command('compilesprites')
+		self.assertTrue(get_static_path('CACHE/sprites@2x.webp').exists())
+
+	def test_quantize_option(self):
+		conf = {'output': 'CACHE/sprites.png'}
+		self.assertEqual([('CACHE/sprites.png', 'PNG', {})], get_sprite_outputs({**conf, 'quantize': False}))
+		self.assertEqual([('CACHE/sprites.png', 'PNG', {'quantize': 256})], get_sprite_outputs({**conf, 'quantize': True}))
+		self.assertEqual([('CACHE/sprites.png', 'PNG', {'quantize': 2})], get_sprite_outputs({**conf, 'quantize': 2}))
+		for colors in (1, 257, 16.0, '16'):
+			with self.assertRaises(ImproperlyConfigured):
+				get_sprite_outputs({**conf, 'quantize': colors})
+
+	@override_settings(
+		ASSETS_MANAGER_SPRITES = [
+			{
+				'name': 'main',
+				'output': 'CACHE/sprites.png',
+				'scss_output': 'CACHE/sprites.scss',
+				'images': (
+					{
+						'name': 'src.png',
+						'src': 'CACHE/src.png',
+					},
+				),
+			},
+		],
+	)
+	def test_stages(self):
+		self.create_image('CACHE/src.png', width=1, height=1)
+		with StageRecorder() as recorder:
+			call_command('compilesprites')
+		self.assertEqual(['find_size', 'pack', 'compose', 'encode', 'scss'], [stage for stage, __ in recorder.stages])
+		self.assertEqual({'output': 'CACHE/sprites.png', 'images': 1}, recorder.get('compose')[0])
+
+	@override_settings(
+		ASSETS_MANAGER_SPRITES = [
+			{
+				'name': 'main',
+				'output': 'CACHE/sprites.png',
+				'scss_output': 'CACHE/sprites.scss',
+				'extra_sizes': [(2, '@2x')],
+				'images': (
+					{'name': 'a', 'src': 'CACHE/a.png'},
+					{'name': 'b', 'src': 'CACHE/b.png'},
+					{'name': 'a_copy', 'src': 'CACHE/a.png'},
+					{'name': 'x', 'src': 'CACHE/x.png', 'mode': 'repeat-x'},
+				),
+			},
+			{
+				'name': 'other',
+				'output': 'CACHE/other.png',
+				'scss_output': 'CACHE/other.scss',
+				'images': (
+					{'name': 'b', 'src': 'CACHE/b.png'},
+					{'name': 'y', 'src': 'CACHE/y.png', 'mode': 'repeat-y'},
+				),
+			},
+		],
+	)
+	def test_banded_compose(self):
+		rnd = random.Random(1)
+		for name, width, height in (('a', 5, 3), ('b', 2, 7), ('x', 3, 2), ('y', 2, 3)):
+			for suffix, ratio in (('', 1), ('@2x', 2)):
+				path = get_static_path(f'CACHE/{name}{suffix}.png')
+				path.parent.mkdir(exist_ok=True, parents=True)
+				size = (width * ratio, height * ratio)
+				Image.frombytes('RGBA', size, bytes(rnd.randrange(256) for __ in range(size[0] * size[1] * 4))).save(path)
+
+		call_command('compilesprites')
+		expected = {}
+		for path in ('CACHE/sprites.png', 'CACHE/sprites@2x.png', 'CACHE/other.png'):
+			with Image.open(get_static_path(path)) as image:
+				expected[path] = (image.size, image.convert('RGBA').tobytes())
+
+		open_image = Image.open
+		with override_settings(ASSETS_MANAGER_SPRITES_MAX_PIXELS=1), StageRecorder() as recorder, mock.patch('PIL.Image.open', side_effect=open_image) as opened:
+			call_command('compilesprites', force=True)
+		# metadata and composition, repeat-y source overlapping every band is decoded once
+		self.assertEqual(2, len([call for call in opened.call_args_list if str(call.args[0]).endswith('CACHE/y.png')]))
+		self.assertTrue(all(info['banded'] for info in recorder.get('compose')))
+		for path, (size, data) in expected.items():
+			with Image.open(get_static_path(path)) as image:
+				self.assertEqual('RGBA', image.mode)
+				self.assertEqual(size, image.size)
+				self.assertEqual(data, image.tobytes())
+			self.assertEqual(0o666 & ~get_umask(), get_static_path(path).stat().st_mode & 0o777)
+		self.assertEqual([], list(get_static_path('CACHE').glob('.*.tmp')))
+
+		# failed band is not written
+		with override_settings(ASSETS_MANAGER_SPRITES_MAX_PIXELS=1), mock.patch('django_assets_manager.utils.PngWriter.write', side_effect=OSError):
+			with self.assertRaises(OSError):
+				call_command('compilesprites', force=True)
+		self.assertEqual([], list(get_static_path('CACHE').glob('.*.tmp')))
+
 	@override_settings(
 		ASSETS_MANAGER_SPRITES = [
 			{
@@ -395,6 +1281,8 @@ class TestCompilesprites(TemplateContextMixin, ImagesTestMixin, TestCase):
 		self.create_image(f'CACHE/normal.png', width=1, height=1)
 		self.create_image(f'CACHE/repeat.png', width=1, height=1)
 		call_command('compilesprites')
+		with Image.open(get_static_path('CACHE/sprites.png')) as image:
+			self.assertIn((255,) * 3, [tuple(image.getpixel((x, y))[3] for x in range(3)) for y in range(3)])
 
 	@override_settings(
 		ASSETS_MANAGER_SPRITES = [
@@ -416,6 +1304,8 @@ class TestCompilesprites(TemplateContextMixin, ImagesTestMixin, TestCase):
 		self.create_image(f'CACHE/normal.png', width=1, height=1)
 		self.create_image(f'CACHE/repeat.png', width=1, height=1)
 		call_command('compilesprites')
+		with Image.open(get_static_path('CACHE/sprites.png')) as image:
+			self.assertIn((255,) * 3, [tuple(image.getpixel((x, y))[3] for y in range(3)) for x in range(3)])
 
 	@override_settings(
 		ASSETS_MANAGER_SPRITES = [
@@ -480,6 +1370,102 @@ class TestCompilesprites(TemplateContextMixin, ImagesTestMixin, TestCase):
 		with self.assertRaises(AssetNotFoundError):
 			call_command('compilesprites')
 
+	@override_settings(
+		ASSETS_MANAGER_SPRITES = [
+			{
+				'name': 'main',
+				'output': 'CACHE/sprites.png',
+				'scss_output': 'CACHE/sprites.scss',
+				'extra_sizes': [(2, '@2x')],
+				'page_size': (4, 4),
+				'images': (
+					{'name': 'small', 'src': 'CACHE/small.png'},
+					{'name': '1', 'src': 'CACHE/big.png'},
+					{'name': '2', 'src': 'CACHE/big.png'},
+					{'name': '3', 'src': 'CACHE/big.png'},
+					{'name': 'strip', 'src': 'CACHE/small.png', 'mode': 'repeat-x'},
+				),
+			},
+		],
+	)
+	def test_pages(self):
+		for ratio, suffix in ((1, ''), (2, '@2x')):
+			self.create_image(f'CACHE/small{suffix}.png', width=ratio, height=ratio)
+			self.create_image(f'CACHE/big{suffix}.png', width=3 * ratio, height=3 * ratio)
+		with StageRecorder() as recorder:
+			call_command('compilesprites')
+		self.assertEqual(4, recorder.get('pack')[0]['pages'])
+		for output, size in (('sprites.png', (1, 3)), ('sprites@2x.png', (2, 6)), ('sprites-1.png', (3, 3)), ('sprites-3@2x.png', (6, 6))):
+			with Image.open(get_static_path('CACHE/' + output)) as image:
+				self.assertEqual(size, image.size)
+		scss = get_static_path('CACHE/sprites.scss').read_text()
+		self.assertIn('_w: 1px,\n_h: 3px,', scss)
+		self.assertIn('_pages: (0: (_w: 1px, _h: 3px, _size: 1px 3px, _ratio: (1 2), _url: (url(static("CACHE/sprites.png")) url(static("CACHE/sprites@2x.png")))), 1: (_w: 3px', scss)
+		self.assertIn('3: (_w: 3px, _h: 3px, _size: 3px 3px, _ratio: (1 2), _url: (url(static("CACHE/sprites-3.png")) url(static("CACHE/sprites-3@2x.png"))))),', scss)
+		self.assertIn('small: (w: 1px, h: 1px, x: 0px, y: 0px, size: 1px 1px, offset: -0px -0px, page: 0)', scss)
+		self.assertIn('strip: (w: 1px, h: 1px, x: 0px, y: 2px, size: 1px 1px, offset: -0px -2px, page: 0)', scss)
+		self.assertIn('3: (w: 3px, h: 3px, x: 0px, y: 0px, size: 3px 3px, offset: -0px -0px, page: 3)', scss)
+		self.assertFalse(check_generated())
+
+	def test_pack_pages(self):
+		pages = Packer.pack_pages([{'name': 'a', 'width': 3, 'height': 2}, {'name': 'b', 'width': 1, 'height': 1, 'mode': 'repeat-y'}], 8, 8, power_of_two=True)
+		self.assertEqual([((8, 2), ['a', 'b'])], [(size, [block['name'] for block in blocks]) for size, blocks in pages])
+		self.assertEqual((7, 0), pages[0][1][1]['pos'])
+		self.assertEqual((1, 2), pages[0][1][1]['size'])
+		with self.assertRaises(NoSpaceError):
+			Packer.pack_pages([{'name': 'a', 'width': 5, 'height': 1}], 4, 4)
+
+		# power of two pages fit to page size
+		pages = Packer.pack_pages([{'name': 'a', 'width': 145, 'height': 145}, {'name': 'b', 'width': 145, 'height': 145}], 300, 300, power_of_two=True)
+		self.assertEqual([(256, 256), (256, 256)], [size for size, __ in pages])
+		with self.assertRaises(NoSpaceError):
+			Packer.pack_pages([{'name': 'a', 'width': 260, 'height': 1}], 300, 300, power_of_two=True)
+		with self.assertRaises(NoSpaceError):
+			Packer.pack_pages([{'name': 'a', 'width': 1, 'height': 5, 'mode': 'repeat-y'}, {'name': 'b', 'width': 5, 'height': 1, 'mode': 'repeat-y'}], 4, 4)
+		with self.assertRaises(NoSpaceError):
+			Packer.pack_pages([{'name': 'a', 'width': 1, 'height': 1, 'mode': 'repeat-x'}, {'name': 'b', 'width': 1, 'height': 1, 'mode': 'repeat-y'}], 4, 4)
+
+	@override_settings(
+		ASSETS_MANAGER_SPRITES = [
+			{
+				'name': 'main',
+				'output': 'CACHE/sprites.png',
+				'scss_output': 'CACHE/sprites.scss',
+				'extra_sizes': [(2, '@2x'), (3, '@3x')],
+				'images': (
+					{'name': '1', 'src': 'CACHE/1.png'},
+					{'name': '2', 'src': 'CACHE/2.png'},
+					{'name': 'x', 'src': 'CACHE/x.png', 'mode': 'repeat-x'},
+				),
+			},
+		],
+	)
+	def test_ratios_share_layout(self):
+		for ratio, suffix in ((1, ''), (2, '@2x'), (3, '@3x')):
+			self.create_image(f'CACHE/1{suffix}.png', width=2 * ratio, height=ratio)
+			self.create_image(f'CACHE/x{suffix}.png', width=ratio, height=ratio)
+		self.create_image('CACHE/2.png', width=1, height=3)
+		with self.assertRaisesRegex(AssetNotFoundError, 'CACHE/2@2x.png, CACHE/2@3x.png'):
+			call_command('compilesprites')
+
+		for ratio, suffix in ((2, '@2x'), (3, '@3x')):
+			self.create_image(f'CACHE/2{suffix}.png', width=ratio, height=3 * ratio)
+		compiler = SpriteCompiler(images=ImageMetadataCache())
+		with StageRecorder() as recorder:
+			configs = compiler.get_sprite_configs(settings.ASSETS_MANAGER_SPRITES[0], compiler.get_sources(settings.ASSETS_MANAGER_SPRITES[0]))
+		self.assertEqual(1, len(recorder.get('pack')))
+		self.assertEqual([1, 2, 3], [config['ratio'] for config in configs])
+		self.assertEqual(['1@3x', '2@3x', 'x@3x'], [image['name'] for image in configs[2]['images']])
+		self.assertEqual('CACHE/2@3x.png', configs[2]['images'][1]['src'])
+		for config in configs:
+			self.assertNotIn('extra_sizes', config)
+			self.assertEqual([image['pos'] for image in configs[0]['images']], [image['pos'] for image in config['images']])
+		self.assertNotIn('pos', settings.ASSETS_MANAGER_SPRITES[0]['images'][0])
+
+		call_command('compilesprites')
+		with Image.open(get_static_path('CACHE/sprites@3x.png')) as image:
+			self.assertEqual((configs[0]['width'] * 3, configs[0]['height'] * 3), image.size)
+
 	@override_settings(
 		ASSETS_MANAGER_SPRITES = [
 			{
@@ -523,3 +1509,254 @@ class TestCompilesprites(TemplateContextMixin, ImagesTestMixin, TestCase):
 		self.create_image(f'CACHE/2.png', width=1, height=1)
 		with self.assertRaises(NoSpaceError):
 			call_command('compilesprites')
+
+	@override_settings(
+		ASSETS_MANAGER_SPRITES = [
+			{
+				'name': 'first',
+				'output': 'CACHE/first.png',
+				'scss_output': 'CACHE/first.scss',
+				'extra_sizes': [(2, '@2x')],
+				'width': 3,
+				'height': 3,
+				'images': (
+					{'name': '1','src': 'CACHE/1.png'},
+				),
+			},
+			{
+				'name': 'second',
+				'output': 'CACHE/second.png',
+				'scss_output': 'CACHE/second.scss',
+				'extra_sizes': [(2, '@2x'), (3, '@3x')],
+				'width': 3,
+				'height': 3,
+				'images': (
+					{'name': '1','src': 'CACHE/1.png'},
+					{'name': '2','src': 'CACHE/2.png'},
+				),
+			},
+		],
+	)
+	def test_parallel_jobs(self):
+		for ratio, suffix in ((1, ''), (2, '@2x'), (3, '@3x')):
+			self.create_image(f'CACHE/1{suffix}.png', width=ratio, height=ratio)
+			self.create_image(f'CACHE/2{suffix}.png', width=ratio, height=ratio)
+		call_command('compilesprites', jobs=2)
+		for output in ('first.png', 'first@2x.png', 'second.png', 'second@2x.png', 'second@3x.png'):
+			self.assertTrue(get_static_path('CACHE/' + output).exists())
+		with Image.open(get_static_path('CACHE/second@3x.png')) as img:
+			self.assertEqual((9, 9), img.size)
+		self.assertIn('second: (', get_static_path('CACHE/second.scss').read_text())
+		self.assertIn('2: (w: 1px, h: 1px, x: 2px, y: 0px', get_static_path('CACHE/second.scss').read_text())
+
+		sprites = deepcopy(settings.ASSETS_MANAGER_SPRITES)
+		sprites[1]['width'] = 1
+		sprites[1]['height'] = 1
+		with override_settings(ASSETS_MANAGER_SPRITES=sprites):
+			with self.assertRaises(NoSpaceError):
+				call_command('compilesprites', jobs=2)
+
+	@override_settings(
+		ASSETS_MANAGER_SPRITES = [
+			{
+				'name': 'first',
+				'output': 'CACHE/first.png',
+				'scss_output': 'CACHE/first.scss',
+				'extra_sizes': [(2, '@2x')],
+				'width': 3,
+				'height': 3,
+				'images': (
+					{'name': '1','src': 'CACHE/1.png'},
+				),
+			},
+			{
+				'name': 'second',
+				'output': 'CACHE/second.png',
+				'scss_output': 'CACHE/second.scss',
+				'width': 3,
+				'height': 3,
+				'images': (
+					{'name': '2','src': 'CACHE/2.png'},
+				),
+			},
+		],
+	)
+	def test_incremental_build(self):
+		self.create_image('CACHE/1.png', width=1, height=1)
+		self.create_image('CACHE/1@2x.png', width=2, height=2)
+		self.create_image('CACHE/2.png', width=1, height=1)
+		call_command('compilesprites')
+		self.assertTrue(get_static_path('CACHE/.first.png.json').exists())
+
+		outputs = ['first.png', 'first@2x.png', 'first.scss', 'second.png', 'second.scss']
+		older_time = int(datetime.now().timestamp()) - 1000
+		for output in outputs:
+			os.utime(get_static_path('CACHE/' + output), (older_time, older_time))
+
+		def rebuilt_outputs():
+			rebuilt = [output for output in outputs if get_static_path('CACHE/' + output).stat().st_mtime != older_time]
+			for output in rebuilt:
+				os.utime(get_static_path('CACHE/' + output), (older_time, older_time))
+			return rebuilt
+
+		# nothing changed, sources with new mtime
+		os.utime(get_static_path('CACHE/1.png'))
+		call_command('compilesprites')
+		self.assertEqual([], rebuilt_outputs())
+
+		# content of source changed
+		self.create_image('CACHE/1@2x.png', width=2, height=1)
+		call_command('compilesprites')
+		self.assertEqual(['first.png', 'first@2x.png'], rebuilt_outputs())
+
+		# output removed
+		get_static_path('CACHE/second.png').unlink()
+		call_command('compilesprites')
+		self.assertEqual(['second.png'], rebuilt_outputs())
+
+		call_command('compilesprites', force=True)
+		self.assertEqual(['first.png', 'first@2x.png', 'second.png'], rebuilt_outputs())
+
+		# configuration changed
+		sprites = deepcopy(settings.ASSETS_MANAGER_SPRITES)
+		sprites[1]['width'] = 4
+		with override_settings(ASSETS_MANAGER_SPRITES=sprites):
+			call_command('compilesprites')
+		self.assertEqual(['second.png', 'second.scss'], rebuilt_outputs())
+
+	@override_settings(
+		ASSETS_MANAGER_SPRITES = [
+			{
+				'name': 'main',
+				'output': 'CACHE/sprites.png',
+				'scss_output': 'CACHE/sprites.scss',
+				'extra_sizes': [(2, '@2x')],
+				'images': (
+					{'name': '1','src': 'CACHE/1.png'},
+					{'name': '2','src': 'CACHE/2.png'},
+					{'name': 'repeat','src': 'CACHE/repeat.png', 'mode': 'repeat-x'},
+				),
+			},
+			{
+				'name': 'pow',
+				'output': 'CACHE/pow.png',
+				'scss_output': 'CACHE/pow.scss',
+				'power_of_two': True,
+				'images': (
+					{'name': '1','src': 'CACHE/1.png'},
+					{'name': '2','src': 'CACHE/2.png'},
+				),
+			},
+		],
+	)
+	def test_automatic_size(self):
+		for ratio, suffix in ((1, ''), (2, '@2x')):
+			self.create_image(f'CACHE/1{suffix}.png', width=3 * ratio, height=2 * ratio)
+			self.create_image(f'CACHE/2{suffix}.png', width=2 * ratio, height=2 * ratio)
+			self.create_image(f'CACHE/repeat{suffix}.png', width=1 * ratio, height=1 * ratio)
+		call_command('compilesprites')
+		with Image.open(get_static_path('CACHE/sprites.png')) as img:
+			self.assertEqual((6, 4), img.size)
+		with Image.open(get_static_path('CACHE/sprites@2x.png')) as img:
+			self.assertEqual((12, 8), img.size)
+		with Image.open(get_static_path('CACHE/pow.png')) as img:
+			self.assertEqual((8, 2), img.size)
+		self.assertIn('_size: 6px 4px', get_static_path('CACHE/sprites.scss').read_text())
+
+
+class TestImageMetadataCache(ImagesTestMixin, TestCase):
+	def setUp(self):
+		clear_cached_static_files()
+
+	@classmethod
+	def tearDownClass(cls):
+		clear_cached_static_files()
+		super().tearDownClass()
+
+	def test_persistent_cache(self):
+		self.create_image('CACHE/opaque.png', width=3, height=2)
+		transparent = Image.new('RGBA', (4, 4))
+		transparent.paste((255, 0, 0, 255), (1, 2, 3, 3))
+		transparent.save(get_static_path('CACHE/transparent.png'))
+		Image.new('RGBA', (4, 4)).save(get_static_path('CACHE/empty.png'))
+
+		cache_path = get_static_path('CACHE/images.json')
+		cache = ImageMetadataCache(cache_path)
+		opaque = cache.get(get_static_path('CACHE/opaque.png'))
+		self.assertEqual((3, 2, [0, 0, 3, 2]), (opaque['width'], opaque['height'], opaque['bbox']))
+		self.assertEqual([1, 2, 3, 3], cache.get(get_static_path('CACHE/transparent.png'))['bbox'])
+		self.assertIsNone(cache.get(get_static_path('CACHE/empty.png'))['bbox'])
+		cache.save()
+
+		cache = ImageMetadataCache(cache_path)
+		self.assertEqual(opaque, cache.get(get_static_path('CACHE/opaque.png')))
+		self.assertFalse(cache.changed)
+
+		# changed file
+		self.create_image('CACHE/opaque.png', width=5, height=5)
+		self.assertEqual(5, cache.get(get_static_path('CACHE/opaque.png'))['width'])
+		self.assertTrue(cache.changed)
+
+		# invalid cache file
+		for content in ('invalid', '{"version": 0}'):
+			cache_path.write_text(content)
+			cache = ImageMetadataCache(cache_path)
+			cache.get(get_static_path('CACHE/opaque.png'))
+			self.assertTrue(cache.changed)
+
+		# memory only cache
+		cache = ImageMetadataCache()
+		cache.get(get_static_path('CACHE/opaque.png'))
+		cache.save()
+
+	def test_cache_path_setting(self):
+		with override_settings(ASSETS_MANAGER_IMAGE_CACHE=False):
+			self.assertIsNone(get_image_cache_path())
+		with override_settings(ASSETS_MANAGER_IMAGE_CACHE='/tmp/images.json'):
+			self.assertEqual('/tmp/images.json', get_image_cache_path())
+		with override_settings():
+			del settings.ASSETS_MANAGER_IMAGE_CACHE
+			self.assertEqual(get_static_path('.assets_manager_images.json'), get_image_cache_path())
+
+
+class TestPacker(TestCase):
+	def assert_valid_layout(self, blocks, width, height):
+		rects = []
+		for block in blocks:
+			x, y = block['pos']
+			w, h = block['size']
+			self.assertTrue(x >= 0 and y >= 0 and x + w <= width and y + h <= height)
+			for other in rects:
+				self.assertTrue(x + w < other[0] or other[2] < x or y + h < other[1] or other[3] < y)
+			rects.append((x, y, x + w, y + h))
+
+	def test_random_blocks(self):
+		rnd = random.Random(0)
+		for __ in range(50):
+			blocks = [{'name': str(i), 'width': rnd.randint(1, 20), 'height': rnd.randint(1, 20)} for i in range(rnd.randint(0, 40))]
+			width, height = Packer.find_size(blocks, power_of_two=rnd.random() < 0.5)
+			Packer(width, height).fit(blocks)
+			self.assert_valid_layout(blocks, width, height)
+
+	def test_repeat_strips_size(self):
+		blocks = [
+			{'name': 'normal', 'width': 4, 'height': 4},
+			{'name': 'repeat', 'width': 1, 'height': 10, 'mode': 'repeat-y'},
+		]
+		self.assertEqual((6, 4), Packer.find_size(blocks))
+		self.assertEqual((1, 1), Packer.find_size([]))
+
+	def test_square_size(self):
+		blocks = [{'name': str(i), 'width': 32, 'height': 32} for i in range(100)]
+		self.assertEqual((329, 329), Packer.find_size(blocks))
+		self.assertEqual((512, 256), Packer.find_size(blocks, power_of_two=True))
+
+		# sides are limited
+		lines = [{'name': str(i), 'width': 30, 'height': 1} for i in range(40)]
+		self.assertEqual((62, 39), Packer.find_size(lines))
+		self.assertEqual((70, 39), Packer.find_size(lines, max_size=70))
+		Packer(70, 39).fit(lines)
+		with self.assertRaises(NoSpaceError):
+			Packer.find_size(blocks, max_size=100)
+		with self.assertRaises(NoSpaceError):
+			Packer.find_size(blocks, max_size=31)
@@ -1,3 +1,11 @@
 # -*- coding: utf-8 -*-
+from django.urls import path
+
+from . import views
+
+
 urlpatterns = [
+	path('preload/', views.preload),
+	path('no-preload/', views.no_preload),
+	path('template-preload/', views.TemplatePreloadView.as_view()),
 ]
@@ -1 +1,24 @@
 # -*- coding: utf-8 -*-
+from django.http import HttpResponse
+from django.views.generic import View
+
+from django_assets_manager.middleware import preload_assets
+
+
+@preload_assets('app')
+def preload(request):
+	response = HttpResponse()
+	if 'font' in request.GET:
+		response['Link'] = '</static/font.woff2>; rel=preload; as=font'
+	return response
+
+
+def no_preload(request):
+	return HttpResponse()
+
+
+class TemplatePreloadView(View):
+	template_name = 'page.html'
+
+	def get(self, request):
+		return HttpResponse()